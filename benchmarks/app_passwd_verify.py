@@ -0,0 +1,63 @@
+"""
+Measure app password verifications per second on one core: a full
+sha512_crypt check at several round counts, and a check answered from the
+verification cache.
+
+Usage:
+    python benchmarks/app_passwd_verify.py [--rounds 5000,100000,656000]
+        [--seconds 3]
+
+Run from the repository root so selfservice is importable.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from passlib.hash import sha512_crypt as sha512
+
+sys.path.insert(0, os.getcwd())
+
+# pylint: disable-next=wrong-import-position
+from selfservice.utilities.app_passwd import _credential_key, verified
+
+
+def rate(func, seconds):
+    """
+    Calls of func per second, measured for about seconds.
+    """
+    count, started = 0, time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        func()
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    """
+    Print verifications per second for each configuration.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rounds", default="5000,100000,656000")
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    password = "correct-horse-battery-staple"
+    print(f"sha512_crypt backend: {sha512.get_backend()}")
+    for rounds in (int(value) for value in args.rounds.split(",")):
+        stored = sha512.using(rounds=rounds).hash(password)
+        per_second = rate(lambda: sha512.verify(password, stored), args.seconds)
+        print(f"{rounds:>8} rounds  {per_second:12.1f} verifications/s")
+
+    key = _credential_key("bench", password)
+    verified.set(key, stored)
+    per_second = rate(
+        lambda: verified.get(_credential_key("bench", password)) == stored,
+        args.seconds,
+    )
+    print(f"{'cached':>15}  {per_second:12.1f} verifications/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+"""
+In-process stand-ins for every service selfservice talks to, for the flow
+benchmark. Each one answers like the real service for the calls selfservice
+makes and counts the calls it receives.
+
+- Keycloak, the FreeIPA JSON API and Twilio are served at the transport
+  level: every request sent through requests (the shared HTTP session,
+  python-keycloak, python_freeipa and twilio) is answered by FakeHTTP.
+- CSHLDAP is replaced by FakeCSHLDAP, whose members all have one external
+  email address and one mobile number.
+- python-ldap connections to FreeIPA are FakeLDAPObjects.
+- The FreeIPA SRV record resolves to a single fake host.
+- Email goes to an aiosmtpd server on localhost.
+"""
+
+import base64
+import json
+import os
+import re
+import socket
+import threading
+import time
+from collections import Counter
+from email import message_from_bytes
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+IPA_HOST = "ipa.bench.invalid"
+
+
+class Calls:
+    """
+    Thread-safe count of outbound calls per service.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def add(self, service):
+        """
+        Count one call to service.
+        """
+        with self._lock:
+            self._counts[service] += 1
+
+    def take(self):
+        """
+        Return the counts so far and start again from zero.
+        """
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        return counts
+
+
+calls = Calls()
+
+
+class Inbox:
+    """
+    Messages delivered to fake recipients, waited on by address.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._messages = {}
+
+    def put(self, recipient, body):
+        """
+        Store the latest message for recipient.
+        """
+        with self._cond:
+            self._messages[recipient] = body
+            self._cond.notify_all()
+
+    def wait(self, recipient, timeout=30):
+        """
+        Return and forget the message for recipient, waiting for it to arrive.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: recipient in self._messages, timeout=timeout
+            ):
+                raise TimeoutError(f"Nothing delivered to {recipient}")
+            return self._messages.pop(recipient)
+
+
+inbox = Inbox()
+
+
+class FakeMember:
+    """
+    Just enough of csh_ldap's CSHMember for the recovery flow.
+    """
+
+    def __init__(self, uid):
+        number = int(re.sub("[^0-9]", "", uid) or 0)
+        self._attrs = {
+            "uid": [uid],
+            "mail": [f"{uid}@example.com", f"{uid}@rit.edu"],
+            "mobile": [f"585{number % 10**7:07}"],
+            "telephoneNumber": [],
+            "ritDn": [],
+        }
+
+    def __getattr__(self, name):
+        values = self._attrs.get(name)
+        return values[0] if values else None
+
+    def get(self, name):
+        """
+        Every value of an attribute.
+        """
+        return self._attrs.get(name, [])
+
+    @staticmethod
+    def groups():
+        """
+        Nobody is an RTP or a failed member.
+        """
+        return []
+
+
+class FakeCSHLDAP:
+    """
+    Stand-in for csh_ldap.CSHLDAP.
+    """
+
+    def __init__(self, *_args, **_kwargs):
+        calls.add("ldap")
+
+    @staticmethod
+    def get_member(val, uid=False):
+        """
+        Look up a member; every uid exists.
+        """
+        calls.add("ldap")
+        if not uid:
+            raise KeyError(val)
+        return FakeMember(val)
+
+
+class FakeLDAPObject:
+    """
+    Stand-in for a python-ldap connection to FreeIPA.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+
+    def set_option(self, *_args):
+        """
+        Options are accepted and ignored.
+        """
+
+    @staticmethod
+    def simple_bind_s(*_args):
+        """
+        Any bind succeeds.
+        """
+        calls.add("freeipa_ldap")
+
+    @staticmethod
+    def whoami_s():
+        """
+        Report the bound identity.
+        """
+        calls.add("freeipa_ldap")
+        return "dn:uid=selfservice"
+
+    @staticmethod
+    def modify_s(*_args):
+        """
+        Any modification succeeds.
+        """
+        calls.add("freeipa_ldap")
+
+    def unbind_s(self):
+        """
+        Nothing to close.
+        """
+
+
+class _SRVTarget:
+    """
+    Target name of a fake SRV record.
+    """
+
+    def __init__(self, host):
+        self.host = host
+
+    def to_text(self):
+        """
+        Absolute name, as dnspython returns it.
+        """
+        return self.host + "."
+
+
+class _SRVRecord:
+    """
+    One fake SRV record.
+    """
+
+    def __init__(self, host):
+        self.priority, self.weight, self.port = 0, 100, 636
+        self.target = _SRVTarget(host)
+
+
+class FakeSRVAnswer(list):
+    """
+    Resolver answer holding one SRV record for IPA_HOST.
+    """
+
+    class rrset:  # pylint: disable=invalid-name,too-few-public-methods
+        """
+        TTL of the answer.
+        """
+
+        ttl = 3600
+
+    def __init__(self):
+        super().__init__([_SRVRecord(IPA_HOST)])
+
+
+def fake_resolve(*_args, **_kwargs):
+    """
+    Stand-in for dns.resolver.resolve.
+    """
+    return FakeSRVAnswer()
+
+
+def _response(request, status=200, body=None, headers=None):
+    """
+    Build a requests Response for request.
+    """
+    response = requests.Response()
+    response.status_code = status
+    response.request = request
+    response.url = request.url
+    response.encoding = "utf-8"
+    response.headers = CaseInsensitiveDict(headers or {})
+    if isinstance(body, (dict, list)):
+        response.headers.setdefault("Content-Type", "application/json")
+        body = json.dumps(body)
+    response._content = (body or "").encode()  # pylint: disable=protected-access
+    return response
+
+
+class FakeHTTP:
+    """
+    Answers requests meant for Keycloak, FreeIPA and Twilio, after waiting
+    latency seconds like a real network round trip would.
+
+    Keyword arguments:
+    latency -- Seconds added to every call
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._original = None
+
+    def install(self):
+        """
+        Route every request sent by requests through this fake.
+        """
+        self._original = HTTPAdapter.send
+        fake = self
+
+        def send(_adapter, request, **_kwargs):
+            return fake.handle(request)
+
+        HTTPAdapter.send = send
+
+    def uninstall(self):
+        """
+        Restore the real transport.
+        """
+        HTTPAdapter.send = self._original
+
+    def handle(self, request):
+        """
+        Dispatch one request by host.
+        """
+        url = urlparse(request.url)
+        if self.latency:
+            time.sleep(self.latency)
+        if url.hostname == "sso.csh.rit.edu":
+            calls.add("keycloak")
+            return self._keycloak(request, url)
+        if url.hostname == IPA_HOST:
+            calls.add("freeipa")
+            return self._freeipa(request, url)
+        if url.hostname == "api.twilio.com":
+            calls.add("twilio")
+            return self._twilio(request)
+        raise requests.ConnectionError(f"No fake for {url.hostname}")
+
+    @staticmethod
+    def _keycloak(request, url):
+        """
+        Token grants, discovery, user lookups and the totp-api.
+        """
+        path = url.path
+        if path.endswith("/protocol/openid-connect/token"):
+            return _response(
+                request,
+                body={
+                    "access_token": "bench-access",
+                    "expires_in": 300,
+                    "refresh_token": "bench-refresh",
+                    "refresh_expires_in": 1800,
+                },
+            )
+        if path.endswith("/.well-known/openid-configuration"):
+            return _response(request, body={"issuer": f"https://{url.hostname}"})
+        if path.endswith("/admin/realms/csh/users"):
+            username = parse_qs(url.query)["username"][0]
+            return _response(
+                request, body=[{"id": f"id-{username}", "username": username}]
+            )
+        if "/totp-api/" in path:
+            if "/isRegistered/" in path:
+                return _response(request, status=404, body={})
+            if path.endswith("/generate"):
+                secret = base64.b32encode(os.urandom(20)).decode()
+                return _response(request, body={"encodedSecret": secret})
+            return _response(request, body={})
+        return _response(request, status=404, body={})
+
+    @staticmethod
+    def _freeipa(request, url):
+        """
+        Password changes, logins and JSON-RPC calls. Every member has two
+        OTP tokens.
+        """
+        if url.path.endswith("/session/change_password"):
+            return _response(request, headers={"X-IPA-Pwchange-Result": "ok"})
+        if url.path.endswith("/session/login_password"):
+            return _response(request, headers={"Set-Cookie": "ipa_session=bench"})
+        if url.path.endswith("/session/json"):
+            call = json.loads(request.body)
+            if call["method"] == "otptoken_find":
+                owner = call["params"][1]["ipatokenowner"]
+                tokens = [{"ipatokenuniqueid": [f"{owner}-{n}"]} for n in range(2)]
+                result = {"result": tokens, "count": len(tokens)}
+            elif call["method"] == "batch":
+                calls_made = call["params"][0][0]
+                result = {
+                    "count": len(calls_made),
+                    "results": [{"result": None, "error": None}] * len(calls_made),
+                }
+            else:
+                result = {"result": None}
+            return _response(request, body={"result": result, "error": None})
+        return _response(request, status=404)
+
+    @staticmethod
+    def _twilio(request):
+        """
+        Message creation; the SMS lands in the inbox.
+        """
+        form = parse_qs(request.body if isinstance(request.body, str) else "")
+        if isinstance(request.body, bytes):
+            form = parse_qs(request.body.decode())
+        inbox.put(form["To"][0], form["Body"][0])
+        return _response(
+            request,
+            status=201,
+            body={"sid": "SMbench", "status": "queued", "to": form["To"][0]},
+        )
+
+
+class SMTPSink:
+    """
+    aiosmtpd handler that files every email in the inbox.
+    """
+
+    # pylint: disable-next=invalid-name
+    async def handle_DATA(self, _server, _session, envelope):
+        """
+        Accept a message.
+        """
+        calls.add("smtp")
+        body = message_from_bytes(envelope.content).get_payload(decode=True)
+        for recipient in envelope.rcpt_tos:
+            inbox.put(recipient, body.decode())
+        return "250 Message accepted"
+
+
+def start_smtp():
+    """
+    Start the SMTP sink on a free local port and return its controller.
+    """
+    # Only needed by the benchmark, so only imported when it runs.
+    from aiosmtpd.controller import (
+        Controller,
+    )  # pylint: disable=import-outside-toplevel
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    controller = Controller(SMTPSink(), hostname="127.0.0.1", port=port)
+    controller.start()
+    return controller
@@ -0,0 +1,80 @@
+"""
+Compare the average time to send an email when opening a new SMTP session
+for every message, when reusing sessions from SMTPPool, and when sending the
+whole batch with SMTPPool.send_many.
+
+Usage:
+    python benchmarks/smtp_send.py [--messages 300]
+
+Run from the repository root so selfservice is importable. Needs aiosmtpd
+on top of the application's requirements.
+"""
+
+import argparse
+import os
+import smtplib
+import sys
+import time
+
+import fakes
+
+sys.path.insert(0, os.getcwd())
+os.environ.setdefault("WARM_UP", "false")
+
+# pylint: disable-next=wrong-import-position
+from selfservice.utilities.smtp import SMTPPool, make_message
+
+
+def per_message(func, messages):
+    """
+    Average milliseconds per message taken by func(messages).
+    """
+    started = time.perf_counter()
+    func(messages)
+    return (time.perf_counter() - started) * 1000 / len(messages)
+
+
+def main():
+    """
+    Print the average time per message for each way of sending.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=300)
+    args = parser.parse_args()
+
+    controller = fakes.start_smtp()
+    messages = [
+        make_message(
+            "selfservice@csh.rit.edu",
+            f"rtp{number}@csh.rit.edu",
+            "Benchmark",
+            "Hello",
+        )
+        for number in range(args.messages)
+    ]
+
+    def connect_per_send(batch):
+        for message in batch:
+            with smtplib.SMTP(controller.hostname, controller.port) as server:
+                server.send_message(message)
+
+    pool = SMTPPool(controller.hostname, controller.port)
+
+    def pooled(batch):
+        for message in batch:
+            pool.send(message)
+
+    try:
+        for name, func in (
+            ("connect per send", connect_per_send),
+            ("pooled send", pooled),
+            ("send_many", pool.send_many),
+        ):
+            print(f"{name:>16}  {per_message(func, messages):8.2f} ms/message")
+    finally:
+        pool.close()
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Compare gunicorn's sync workers with the threaded gthread workers
+gunicorn_conf.py uses, at the same number of worker processes and so roughly
+the same memory.
+
+By default gunicorn serves a stand-in app from this file whose requests only
+wait, like ours do while LDAP, FreeIPA or Keycloak answer. --app and --path
+point it at a real application instead.
+
+Usage:
+    python benchmarks/worker_models.py [--workers 2] [--threads 8]
+        [--clients 32] [--duration 10] [--delay-ms 50]
+        [--app selfservice:app --path /health]
+
+Memory is read from /proc, so this only runs on Linux.
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+DELAY = float(os.environ.get("BENCH_DELAY_MS", "50")) / 1000
+
+
+def app(_environ, start_response):
+    """
+    WSGI app standing in for a request that waits on a backing service.
+    """
+    time.sleep(DELAY)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+
+def free_port():
+    """
+    Pick a free local TCP port.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid):
+    """
+    Resident memory of pid and all its children, in MB.
+    """
+    pids = [pid] + [
+        int(entry)
+        for entry in os.listdir("/proc")
+        if entry.isdigit() and _parent(entry) == pid
+    ]
+    total = 0
+    for each in pids:
+        try:
+            with open(f"/proc/{each}/status", encoding="ascii") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total / 1024
+
+
+def _parent(pid):
+    """
+    Parent PID of pid, or None if it has exited.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as stat:
+            return int(stat.read().rsplit(")", 1)[1].split()[1])
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+def start_gunicorn(target, port, worker_class, workers, threads, delay_ms):
+    """
+    Boot gunicorn and wait until it accepts connections.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            target,
+            f"--bind=127.0.0.1:{port}",
+            f"--worker-class={worker_class}",
+            f"--workers={workers}",
+            f"--threads={threads}",
+            "--log-level=warning",
+        ],
+        cwd=here if target.startswith("worker_models:") else os.getcwd(),
+        env={**os.environ, "BENCH_DELAY_MS": str(delay_ms)},
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            # Workers may still be booting after the master has bound.
+            time.sleep(1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def load(port, path, clients, duration):
+    """
+    Send requests from clients threads for duration seconds. Returns the
+    list of latencies in ms and the number of failed requests.
+    """
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine, failed = [], 0
+        while time.monotonic() < stop:
+            began = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            mine.append((time.perf_counter() - began) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def main():
+    """
+    Run the same load against both worker models and print the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--delay-ms", type=float, default=50)
+    parser.add_argument("--app", default="worker_models:app")
+    parser.add_argument("--path", default="/")
+    args = parser.parse_args()
+
+    for worker_class, threads in (("sync", 1), ("gthread", args.threads)):
+        port = free_port()
+        process = start_gunicorn(
+            args.app, port, worker_class, args.workers, threads, args.delay_ms
+        )
+        try:
+            latencies, errors = load(port, args.path, args.clients, args.duration)
+            memory = rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+
+        latencies.sort()
+        throughput = len(latencies) / args.duration
+        print(
+            f"{worker_class:<8} {args.workers} workers x {threads:<3} threads  "
+            f"{throughput:8.1f} req/s  "
+            f"p50 {statistics.median(latencies) if latencies else 0:8.1f} ms  "
+            f"p99 {latencies[int(len(latencies) * 0.99)] if latencies else 0:8.1f} ms  "
+            f"{errors} errors  {memory:6.1f} MB RSS  "
+            f"{throughput / memory * 100 if memory else 0:8.1f} req/s per 100 MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
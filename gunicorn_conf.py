@@ -1,23 +1,63 @@
+import glob
 import os
 import subprocess
+import sys
 
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate, upgrade
-from flask import Flask
+# Requests spend nearly all their time waiting on LDAP, FreeIPA, Keycloak and
+# Postgres, so each worker serves several at once on threads. The clients
+# those threads share are thread-safe, and their pools (DB_POOL_SIZE plus
+# DB_MAX_OVERFLOW, HTTP_POOL_MAXSIZE) should be at least as large as
+# GUNICORN_THREADS. gevent is not supported: python-ldap blocks in C without
+# yielding to the event loop.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# With threads a slow request no longer stalls the worker's heartbeat, so
+# this only catches workers that are truly stuck.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
 
-app = Flask(__name__)
-
-if os.path.exists(os.path.join(os.getcwd(), "config.py")):
-	app.config.from_pyfile(os.path.join(os.getcwd(), "config.py"))
-else:
-	app.config.from_pyfile(os.path.join(os.getcwd(), "config.env.py"))
-
-# Create the database session and import models.
-db = SQLAlchemy(app)
-from selfservice.models import *
-migrate = Migrate(app, db)
 
 def on_starting(server):
+	# Metrics left behind by a previous run would be added to this one.
+	metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+	if metrics_dir:
+		for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+			os.remove(path)
+
+	# Migrate in a child process, so the master never imports the app and
+	# workers do not inherit its clients, pools and threads through fork.
 	if not os.path.exists(os.path.join(os.getcwd(), "data.db")):
-		with app.app_context():
-			upgrade()
+		subprocess.run(
+			[sys.executable, "-m", "flask", "--app", "selfservice", "db", "upgrade"],
+			check=True,
+		)
+
+
+def post_fork(server, worker):
+	# If the app was preloaded, connections inherited from the master must
+	# not be shared between workers, so drop them without closing the
+	# master's sockets.
+	from selfservice import app, db
+	from selfservice.utilities.startup import start_warm_up
+
+	with app.app_context():
+		db.engine.dispose(close=False)
+
+	# Clients connect on first use; get that done before requests arrive.
+	start_warm_up()
+
+	# Send whatever an earlier run left queued or scheduled for retry, rather
+	# than waiting for the next recovery to wake the delivery threads.
+	from selfservice.utilities.delivery import workers
+
+	workers.wake()
+
+
+def child_exit(server, worker):
+	# Stop reporting gauges of workers that are gone.
+	if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+		from prometheus_client import multiprocess
+
+		multiprocess.mark_process_dead(worker.pid)
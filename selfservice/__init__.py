@@ -6,12 +6,12 @@ Rochester Institute of Technology
 Author: Marc Billow
 """
 
+import logging
 import os
 import subprocess
-import srvlookup
+import time
 from csh_ldap import CSHLDAP
-from flask import Flask, render_template, request, redirect, url_for, flash
-from flask_pyoidc.flask_pyoidc import OIDCAuthentication
+from flask import Flask, render_template, request, redirect, url_for, flash, g
 from flask_pyoidc.provider_configuration import ProviderConfiguration, ClientMetadata
 from flask_xcaptcha import XCaptcha
 from flask_sqlalchemy import SQLAlchemy
@@ -25,6 +25,20 @@ import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 
+from selfservice.utilities.db_pool import TimedQueuePool, instrument, pool_stats
+from selfservice.utilities.lazy import Lazy, LazyOIDCAuthentication
+from selfservice.utilities.ldap_pool import LDAPConnectionPool
+from selfservice.utilities.metrics import (
+    STARTUP_DURATION,
+    instrument_engine,
+    observe_request,
+    record_pools,
+    render,
+)
+from selfservice.utilities.srv import SRVResolver
+
+LOG = logging.getLogger(__name__)
+setup_started = time.perf_counter()
 
 app = Flask(__name__)
 
@@ -33,9 +47,12 @@ if os.path.exists(os.path.join(os.getcwd(), "config.py")):
 else:
     app.config.from_pyfile(os.path.join(os.getcwd(), "config.env.py"))
 
-# Get Git Revision
-with open("rev", mode="r", encoding="utf-8") as file:
-    version = file.read().rstrip()
+# Get Git Revision, written by the image build
+try:
+    with open("rev", mode="r", encoding="utf-8") as file:
+        version = file.read().rstrip()
+except FileNotFoundError:
+    version = "unknown"
 
 # Setup Sentry tracking
 sentry_sdk.init(
@@ -43,8 +60,14 @@ sentry_sdk.init(
     integrations=[FlaskIntegration(), SqlalchemyIntegration()],
 )
 
-# Create the database session.
+# Create the database session, with a pool that reports checkout waits.
+app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {}).setdefault(
+    "poolclass", TimedQueuePool
+)
 db = SQLAlchemy(app)
+with app.app_context():
+    instrument(db.engine)
+    instrument_engine(db.engine)
 from selfservice.models import *  # pylint: disable=wrong-import-position
 
 migrate = Migrate(app, db)
@@ -53,23 +76,38 @@ migrate = Migrate(app, db)
 if app.config["XCAPTCHA_ENABLED"]:
     xcaptcha = XCaptcha(app=app)
 
-# OIDC Initialization
+# OIDC Initialization. Every client below connects on first use, not at
+# import, so workers boot without waiting on the network.
 OIDC_PROVIDER = "csh"
 client_info = ClientMetadata(**app.config["OIDC_CLIENT_CONFIG"])
 provider = ProviderConfiguration(
     issuer=app.config["OIDC_ISSUER"], client_metadata=client_info
 )
-auth = OIDCAuthentication(app=app, provider_configurations={OIDC_PROVIDER: provider})
+auth = LazyOIDCAuthentication(
+    app=app, provider_configurations={OIDC_PROVIDER: provider}
+)
 
 # Connect to LDAP
-ldap = CSHLDAP(app.config["LDAP_BIND_DN"], app.config["LDAP_BIND_PW"])
+ldap = Lazy(
+    lambda: CSHLDAP(app.config["LDAP_BIND_DN"], app.config["LDAP_BIND_PW"]), "ldap"
+)
 
 # Find FreeIPA server
-ldap_srvs = srvlookup.lookup("ldap", "tcp", "csh.rit.edu")
-ldap_uri = ldap_srvs[0].hostname
+ipa_servers = SRVResolver(
+    "ldap", "tcp", "csh.rit.edu", cooldown=app.config["SRV_UNHEALTHY_COOLDOWN"]
+)
+
+# Pooled LDAPS connections to FreeIPA used for password resets
+ipa_ldap = LDAPConnectionPool(
+    ipa_servers,
+    app.config["LDAP_BIND_DN"],
+    app.config["LDAP_BIND_PW"],
+    size=app.config["LDAP_POOL_SIZE"],
+    timeout=app.config["LDAP_POOL_TIMEOUT"],
+)
 
 # FreeIPA API Connection
-ipa = Client(ldap_uri, version="2.215")
+ipa = Lazy(lambda: Client(ipa_servers.get_host(), version="2.215"), "freeipa")
 
 # Configure rate limiting
 if not app.config["DEBUG"]:
@@ -87,6 +125,10 @@ qr = QRcode(app)
 from selfservice.blueprints.recovery import recovery_bp
 from selfservice.blueprints.change import change_bp
 from selfservice.blueprints.otp import otp_bp
+from selfservice.blueprints.internal import internal_bp
+from selfservice.utilities.retention import prune_command
+from selfservice.utilities import http
+from selfservice.utilities.readiness import readiness
 
 # pylint: enable=wrong-import-position
 
@@ -94,6 +136,42 @@ from selfservice.blueprints.otp import otp_bp
 app.register_blueprint(recovery_bp)
 app.register_blueprint(change_bp)
 app.register_blueprint(otp_bp)
+app.register_blueprint(internal_bp)
+
+# Register CLI commands
+app.cli.add_command(prune_command)
+
+setup_seconds = time.perf_counter() - setup_started
+STARTUP_DURATION.labels("setup").set(setup_seconds)
+LOG.info("Application set up in %.3fs", setup_seconds)
+
+
+# Request metrics
+@app.before_request
+def start_request_timer():
+    """
+    Note when the request started, for the latency histogram.
+    """
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Record request latency and this worker's pool usage.
+    """
+    started = g.get("request_started")
+    if started is not None:
+        observe_request(
+            request.blueprint,
+            request.endpoint,
+            request.method,
+            response.status_code,
+            time.perf_counter() - started,
+        )
+    record_pools(http.pool_stats(), pool_stats(db.engine))
+    return response
+
 
 # Flask Routes
 
@@ -121,3 +199,27 @@ def health():
     Shows an ok status if the application is up and running
     """
     return {"status": "ok"}
+
+
+@app.route("/ready")
+@limiter.exempt
+def ready():
+    """
+    Shows whether every backing service is reachable, with the status and
+    latency of each. Results are cached for a few seconds.
+    """
+    checks = readiness.check()
+    failed = any(check["status"] != "ok" for check in checks.values())
+    return {"status": "fail" if failed else "ok", "checks": checks}, (
+        503 if failed else 200
+    )
+
+
+@app.route("/metrics")
+@limiter.exempt
+def metrics():
+    """
+    Exposes Prometheus metrics for every worker.
+    """
+    body, content_type = render()
+    return body, 200, {"Content-Type": content_type}
@@ -0,0 +1,62 @@
+"""
+Flask blueprint for APIs used by other CSH services rather than members.
+"""
+
+import hmac
+import logging
+from functools import wraps
+
+from flask import Blueprint, abort, current_app, request
+
+from selfservice.utilities.app_passwd import (
+    LookupKeyMissing,
+    VerificationBusy,
+    verify_app_passwd,
+)
+from selfservice.utilities.general import request_text
+from selfservice import limiter
+
+internal_bp = Blueprint("internal", __name__)
+
+LOG = logging.getLogger(__name__)
+
+
+def token_required(view):
+    """
+    Only allow requests carrying the configured internal API token.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config["INTERNAL_API_TOKEN"]
+        if not token:
+            abort(404)
+        presented = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(presented.encode(), f"Bearer {token}".encode()):
+            return {"error": "unauthorized"}, 401
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@internal_bp.route("/internal/app-passwd/verify", methods=["POST"])
+@limiter.exempt
+@token_required
+def app_passwd_verify():
+    """
+    Check a user's app specific password for the mail server.
+    """
+    credentials = request.get_json(silent=True) or request.form
+    username = request_text(credentials, "user")
+    password = request_text(credentials, "password")
+    if not username or not password:
+        return {"error": "user and password are required"}, 400
+
+    try:
+        valid = verify_app_passwd(username, password)
+    except VerificationBusy:
+        return {"error": "too many concurrent verifications"}, 429
+    except LookupKeyMissing:
+        LOG.error("APP_PASSWD_LOOKUP_KEY is not set, cannot verify app passwords")
+        return {"error": "app passwords are not configured"}, 503
+    return {"valid": valid}
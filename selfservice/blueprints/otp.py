@@ -5,11 +5,18 @@ Flask blueprint for handling creating and removing OTP secrets from accounts.
 import logging
 
 import pyotp
-from flask import Blueprint, render_template, request, redirect, flash
+from flask import Blueprint, render_template, request, redirect, flash, abort
 from flask import session as flask_session
 
 from selfservice import version, auth, OIDC_PROVIDER
-from selfservice.utilities.app_passwd import delete_app_passwd
+from selfservice.utilities.app_passwd import (
+    LookupKeyMissing,
+    TooManyAppPasswords,
+    list_app_passwds,
+    revoke_app_passwd,
+    set_app_passwd,
+)
+from selfservice.utilities.general import request_text
 from selfservice.utilities.keycloak import (
     OTPConfigError,
     OTPInvalidCode,
@@ -17,9 +24,8 @@ from selfservice.utilities.keycloak import (
     get_kc_otp_is_registered,
     generate_kc_otp,
     register_kc_otp,
-    delete_kc_otp,
 )
-from selfservice.utilities.ldap import delete_ipa_otp
+from selfservice.utilities.removal import incomplete, remove_two_factor
 
 otp_bp = Blueprint("otp", __name__)
 
@@ -91,18 +97,82 @@ def enable():
 @auth.oidc_auth(OIDC_PROVIDER)
 def disable():
     """
-    Removes any tokens from both Keycloak and FreeIPA
+    Removes any tokens from Keycloak and FreeIPA and any app specific
+    passwords, all at once
     """
 
     username = flask_session["userinfo"].get("preferred_username")
 
-    try:
-        delete_kc_otp(username)
-        delete_ipa_otp(username)
-        delete_app_passwd(username)
-    except OTPConfigError:
-        flash("Error removing two-factor! Please contact and RTP.")
-        LOG.exception("Failed to remove OTP for %s", username)
-        return redirect("/otp")
+    results = remove_two_factor(username)
+    failed = incomplete(results)
+    if failed:
+        flash(
+            f"Error removing two-factor from {', '.join(failed)}! "
+            "Please contact an RTP."
+        )
+        LOG.error("Failed to remove OTP for %s: %s", username, results)
+    else:
+        LOG.info("Removed OTP for %s: %s", username, results)
 
     return redirect("/otp")
+
+
+def _describe(app_passwd):
+    """
+    JSON safe summary of an app password, without its hash.
+    """
+    return {
+        "id": app_passwd.id,
+        "label": app_passwd.label,
+        "created": app_passwd.created.isoformat() if app_passwd.created else None,
+        "last_used": (
+            app_passwd.last_used.isoformat() if app_passwd.last_used else None
+        ),
+    }
+
+
+@otp_bp.route("/otp/app-passwd", methods=["GET"])
+@auth.oidc_auth(OIDC_PROVIDER)
+def list_passwds():
+    """
+    Lists the user's app specific passwords.
+    """
+    username = flask_session["userinfo"].get("preferred_username")
+    return {"app_passwds": [_describe(p) for p in list_app_passwds(username)]}
+
+
+@otp_bp.route("/otp/app-passwd", methods=["POST"])
+@auth.oidc_auth(OIDC_PROVIDER)
+def create_passwd():
+    """
+    Creates an app specific password. It is only ever shown in this response.
+    """
+    username = flask_session["userinfo"].get("preferred_username")
+    params = request.get_json(silent=True) or request.form
+    label = (request_text(params, "label") or "").strip()
+    if not label or len(label) > 64:
+        return {"error": "label must be 1 to 64 characters"}, 400
+
+    try:
+        password, app_passwd = set_app_passwd(username, label)
+    except TooManyAppPasswords:
+        return {"error": "too many app passwords, revoke one first"}, 409
+    except LookupKeyMissing:
+        LOG.error("APP_PASSWD_LOOKUP_KEY is not set, cannot create app passwords")
+        return {"error": "app passwords are not configured"}, 503
+
+    LOG.info("Created app password %d for %s", app_passwd.id, username)
+    return {**_describe(app_passwd), "password": password}, 201
+
+
+@otp_bp.route("/otp/app-passwd/<int:passwd_id>", methods=["DELETE"])
+@auth.oidc_auth(OIDC_PROVIDER)
+def revoke_passwd(passwd_id):
+    """
+    Revokes one of the user's app specific passwords.
+    """
+    username = flask_session["userinfo"].get("preferred_username")
+    if not revoke_app_passwd(username, passwd_id):
+        abort(404)
+    LOG.info("Revoked app password %d for %s", passwd_id, username)
+    return "", 204
@@ -2,23 +2,34 @@
 Flask blueprint for handling identity verification and account recovery.
 """
 
-import uuid
 import logging
 
-from flask import Blueprint, render_template, request, redirect, flash
+from flask import (
+    Blueprint,
+    render_template,
+    request,
+    redirect,
+    flash,
+    current_app,
+    jsonify,
+)
 from flask import session as flask_session
 
-from selfservice.utilities.general import is_expired, email_recovery, phone_recovery
+from selfservice.utilities.general import email_recovery, phone_recovery
+from selfservice.utilities.delivery import delivery_status
+from selfservice.utilities.directory import DirectoryUnavailable
 from selfservice.utilities.reset import (
     generate_token,
     generate_pin,
+    redeem_pin,
     passwd_reset,
-    TokenAlreadyExists,
 )
-from selfservice.utilities.ldap import verif_methods, get_members
+from selfservice.utilities.ldap import verif_methods, search_members
+from selfservice.utilities.keycloak import evict_kc_user_id
+from selfservice.utilities.state import store, TokenAlreadyExists
+from selfservice.utilities.metrics import timed
 
-from selfservice.models import RecoverySession, PhoneVerification, ResetToken
-from selfservice import db, auth, xcaptcha, ldap, version, OIDC_PROVIDER
+from selfservice import auth, xcaptcha, ldap, limiter, version, OIDC_PROVIDER
 
 LOG = logging.getLogger(__name__)
 
@@ -39,7 +50,8 @@ def create_session():
 
         # If we can't find an account, flash error.
         try:
-            member = ldap.get_member(request.form["username"], True)
+            with timed("ldap", "get_member"):
+                member = ldap.get_member(request.form["username"], True)
         except KeyError:
             flash(
                 "Uh oh, either that account doesn't exist or we don't have "
@@ -65,36 +77,49 @@ def create_session():
             )
             return redirect("/recovery")
 
-        # Generate a random UUID for session object.
-        session_id = str(uuid.uuid4())
-
-        # Create the object in the database.
-        session = RecoverySession(id=session_id, username=request.form["username"])
-        db.session.add(session)
-        db.session.commit()
+        # Create the session, along with the verification methods so later
+        # steps don't need to ask LDAP again.
+        session = store.create_session(
+            request.form["username"],
+            methods=verif_methods(request.form["username"], member),
+        )
 
         # Redirect the user to thier session.
-        return redirect("/recovery/" + session_id)
+        return redirect("/recovery/" + session.id)
     flash("Please complete the reCaptcha.")
     return redirect("/recovery")
 
 
+def session_methods(session):
+    """
+    Return the verification methods captured when the session was created,
+    falling back to LDAP for sessions that predate them.
+
+    Keyword arguments:
+    session -- RecoveryState of the session
+    """
+    if session.methods is None:
+        methods = verif_methods(session.username)
+        store.save_methods(session.id, methods)
+        return methods
+    return session.methods
+
+
 @recovery_bp.route("/recovery/<recovery_id>")
 def verify_identity(recovery_id):
     """
     Renders the identity verification options for the user.
     """
 
-    # Retrieve the session object.
-    session = RecoverySession.query.filter_by(id=recovery_id).first()
-    methods = verif_methods(session.username)
-
-    # Make sure it isn't expired.
-    if is_expired(session.created, 10):
+    # Retrieve the session, which only exists until it expires.
+    session = store.get_session(recovery_id)
+    if not session:
         flash("Sorry, your session has expired.")
         return redirect("/recovery")
 
-        # Make sure that methods are valid
+    methods = session_methods(session)
+
+    # Make sure that methods are valid
     possible_methods = 0
     for _, value in methods.items():
         if value:
@@ -127,16 +152,15 @@ def method_selection(recovery_id, method):
     # Parse expected URL paramters.
     index = request.args.get("index", default=0, type=int)
 
-    # Retrieve the session object.
-    session = RecoverySession.query.filter_by(id=recovery_id).first()
-    methods = verif_methods(session.username)
-
-    # Make sure it isn't expired.
-    if is_expired(session.created, 10):
+    # Retrieve the session, which only exists until it expires.
+    session = store.get_session(recovery_id)
+    if not session:
         flash("Sorry, your session has expired.")
         return redirect("/recovery")
 
-        # Get Method
+    methods = session_methods(session)
+
+    # Get Method
     if method == "email":
         # Generate a random UUID for reset token.
         try:
@@ -152,8 +176,15 @@ def method_selection(recovery_id, method):
         rec_email = methods["email"][index]["data"]
 
         try:
-            email_recovery(username=session.username, address=rec_email, token=token)
-            return render_template("success.html", version=version)
+            email_recovery(
+                username=session.username,
+                address=rec_email,
+                token=token,
+                session=session.id,
+            )
+            return render_template(
+                "success.html", recovery_id=session.id, version=version
+            )
         except:
             flash("Uh oh, something went wrong. Please try again later.")
             return redirect("/recovery")
@@ -170,7 +201,9 @@ def method_selection(recovery_id, method):
             return redirect("/recovery")
 
         try:
-            phone_recovery(phone=methods["phone"][index]["data"], token=token)
+            phone_recovery(
+                phone=methods["phone"][index]["data"], token=token, session=session.id
+            )
             return render_template(
                 "phone.html",
                 recovery_id=session.id,
@@ -183,18 +216,24 @@ def method_selection(recovery_id, method):
             return redirect("/recovery")
 
 
+@recovery_bp.route("/recovery/<recovery_id>/delivery")
+@limiter.exempt
+def delivery(recovery_id):
+    """
+    Report the delivery state of messages sent for a recovery session, so the
+    page can tell the user once their email or SMS actually went out.
+    """
+    return jsonify(delivery_status(recovery_id))
+
+
 @recovery_bp.route("/recovery/<recovery_id>/phone/verify", methods=["POST"])
 def verify_phone(recovery_id):
     """
     Check the provided verification code against our stored code.
     """
-    session = RecoverySession.query.filter_by(id=recovery_id).first()
-    token = PhoneVerification.query.filter_by(session=recovery_id).first()
+    token = redeem_pin(recovery_id, request.form["verify"])
 
-    if request.form["verify"] == token.code:
-        token = ResetToken.query.filter_by(session=recovery_id).first()
-        if not token:
-            token = generate_token(session)
+    if token:
         return redirect("/reset?token=" + token)
     flash("Your verification code did not match, sorry!")
     return redirect("/recovery")
@@ -208,15 +247,10 @@ def reset_password():
 
     token = request.args.get("token", default="", type=str)
 
-    token_data = ResetToken.query.filter_by(token=token).first()
+    token_data = store.get_token(token) if token else None
 
     # Redirect if the token provided isn't valid.
-    if (
-        not token
-        or not token_data
-        or is_expired(token_data.created, 30)
-        or token_data.used
-    ):
+    if not token_data:
         flash(
             "Oops! Invalid or expired reset token. Each token is only "
             + "valid for 30 minutes after it is issued."
@@ -230,17 +264,18 @@ def reset_password():
         # Lets actually do the reset.
     if request.form["password"] == request.form["verify"]:
         if len(request.form["password"]) >= 12:
-            passwd_reset(
-                username=token_data.username, password=request.form["password"]
-            )
+            # Claim the token first so it can only ever be used once.
+            token_data = store.claim_token(token)
+            if not token_data:
+                flash("This reset token has already been used.")
+                return redirect("/recovery")
             try:
                 passwd_reset(
                     username=token_data.username, password=request.form["password"]
                 )
-                token_data.used = True
-                db.session.commit()
                 return render_template("success.html", reset=True, version=version)
             except:
+                store.release_token(token_data)
                 flash("LDAP Error Occurred... Please contact an RTP.")
         else:
             flash("Your password does not meet the requirements below.")
@@ -250,61 +285,70 @@ def reset_password():
     return redirect(f"/reset?token={token}")
 
 
+def is_rtp():
+    """
+    Check whether the logged in user is an RTP.
+    """
+    return "/admins/rtp" in flask_session["userinfo"].get("groups")
+
+
 @recovery_bp.route("/admin", methods=["GET", "POST"])
 @auth.oidc_auth(OIDC_PROVIDER)
 def admin():
     """
     Allow RTPs to create reset tokens for accounts.
     """
-    if "/admins/rtp" not in flask_session["userinfo"].get("groups"):
+    if not is_rtp():
         flash("Nice try. 😉 ")
         return redirect("/recovery")
 
     if request.method == "GET":
         token = None
     else:
-        # Generate a random UUID for session object.
-        session_id = str(uuid.uuid4())
-
-        # Create the object in the database.
-        session_data = RecoverySession(id=session_id, username=request.form["username"])
-        db.session.add(session_data)
-        db.session.commit()
+        session = store.create_session(request.form["username"])
+        token = generate_token(session)
 
-        token = generate_token(session_data)
-
-    members = get_members()
     uid = str(flask_session["userinfo"].get("preferred_username", ""))
-    last_sessions = [
-        {
-            "username": s.username,
-            "session_created": s.session_created,
-            "session_expired": (
-                (is_expired(s.session_created, 10) and not s.token_created)
-                or is_expired(s.token_created, 30)
-            ),
-            "token_created": s.token_created,
-            "used": s.used,
-        }
-        for s in RecoverySession.query.outerjoin(
-            ResetToken, RecoverySession.id == ResetToken.session
-        )
-        .with_entities(
-            RecoverySession.username,
-            RecoverySession.created.label("session_created"),
-            ResetToken.created.label("token_created"),
-            ResetToken.used,
-        )
-        .order_by(RecoverySession.created.desc())
-        .limit(20)
-        .all()
-    ]
+    last_sessions = store.recent_sessions(20)
 
     return render_template(
         "admin.html",
         version=version,
-        members=members,
         username=uid,
         sessions=last_sessions,
         token=token,
     )
+
+
+@recovery_bp.route("/admin/members/search")
+@auth.oidc_auth(OIDC_PROVIDER)
+def admin_member_search():
+    """
+    Return the best matching members for the admin page typeahead.
+    """
+    if not is_rtp():
+        return {"error": "forbidden"}, 403
+
+    query = request.args.get("q", default="", type=str)
+    limit = min(
+        request.args.get("limit", default=10, type=int),
+        current_app.config["MEMBER_SEARCH_MAX_RESULTS"],
+    )
+    try:
+        return jsonify(search_members(query, max(limit, 1)))
+    except DirectoryUnavailable:
+        return {"error": "directory loading"}, 503
+
+
+@recovery_bp.route("/admin/keycloak/<username>/evict", methods=["POST"])
+@auth.oidc_auth(OIDC_PROVIDER)
+def evict_keycloak_user(username):
+    """
+    Allow RTPs to drop a cached Keycloak user ID, e.g. after an account was
+    recreated. Every worker forgets it within KC_EVICTION_POLL_INTERVAL
+    seconds; "evicted" says whether the worker serving this request had it.
+    """
+    if not is_rtp():
+        return {"error": "forbidden"}, 403
+
+    return {"username": username, "evicted": evict_kc_user_id(username)}
@@ -9,6 +9,10 @@ from sqlalchemy import (
     ForeignKey,
     DateTime,
     Boolean,
+    JSON,
+    Text,
+    Index,
+    UniqueConstraint,
     func,
 )
 from sqlalchemy.sql.functions import now
@@ -22,10 +26,11 @@ class ResetToken(db.Model):
     """
 
     __tablename__ = "token"
+    __table_args__ = (UniqueConstraint("session", name="uq_token_session"),)
     id = Column(Integer, primary_key=True)
     username = Column(String(64), nullable=False)
     created = Column(DateTime, default=func.timezone("UTC", now()))
-    token = Column(String(36))
+    token = Column(String(36), unique=True, index=True)
     session = Column(String(36), ForeignKey("session.id"))
     used = Column(Boolean)
 
@@ -34,13 +39,15 @@ class RecoverySession(db.Model):
     """
     A recovery session is created once a user enters their username and
     completes the reCaptcha. It is used to track Reset Tokens and Phone
-    Verification numbers per session.
+    Verification numbers per session, along with the verification methods
+    found in LDAP when it was created.
     """
 
     __tablename__ = "session"
     id = Column(String(36), primary_key=True)
     username = Column(String(64), nullable=False)
-    created = Column(DateTime, default=func.timezone("UTC", now()))
+    created = Column(DateTime, default=func.timezone("UTC", now()), index=True)
+    methods = Column(JSON)
 
 
 class PhoneVerification(db.Model):
@@ -51,15 +58,59 @@ class PhoneVerification(db.Model):
 
     __tablename__ = "phone_codes"
     code = Column(String(6), primary_key=True)
-    session = Column(String(36), ForeignKey("session.id"))
+    session = Column(String(36), ForeignKey("session.id"), index=True)
 
 
 class AppSpecificPassword(db.Model):
     """
     Allows users to authenticate to applications that don't support two factor
-    auth. Currently: this is only mail
+    auth. Currently: this is only mail. A user may have several, one per
+    client, each with its own label.
+
+    lookup holds a few characters of a keyed HMAC of the password, so
+    verification only needs to check the hashes it could match.
     """
 
     __tablename__ = "app_passwds"
-    user = Column(String, primary_key=True)
-    password = Column(String)
+    __table_args__ = (Index("ix_app_passwds_user_lookup", "user", "lookup"),)
+    id = Column(Integer, primary_key=True)
+    user = Column(String, nullable=False)
+    label = Column(String(64), nullable=False)
+    hash = Column(String, nullable=False)
+    lookup = Column(String(4))
+    created = Column(DateTime, default=func.timezone("UTC", now()))
+    last_used = Column(DateTime)
+
+
+class OutboundMessage(db.Model):
+    """
+    An email or SMS waiting to be, or already, delivered by the background
+    delivery workers. Rows double as the delivery status shown to users.
+    """
+
+    __tablename__ = "outbound_message"
+    __table_args__ = (Index("ix_outbound_message_due", "status", "next_attempt"),)
+    id = Column(Integer, primary_key=True)
+    # Not a foreign key, since sessions may live outside the database.
+    session = Column(String(36), index=True)
+    channel = Column(String(8), nullable=False)
+    recipient = Column(String, nullable=False)
+    subject = Column(String)
+    body = Column(Text, nullable=False)
+    status = Column(String(16), nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, default=func.timezone("UTC", now()))
+    last_error = Column(Text)
+    created = Column(DateTime, default=func.timezone("UTC", now()))
+    sent = Column(DateTime)
+
+
+class KeycloakUserEviction(db.Model):
+    """
+    Usernames whose cached Keycloak ID an RTP asked to drop. Every worker
+    polls this table so the eviction reaches all of their caches.
+    """
+
+    __tablename__ = "kc_user_evictions"
+    username = Column(String(64), primary_key=True)
+    evicted = Column(DateTime, nullable=False, index=True)
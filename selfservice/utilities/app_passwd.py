@@ -2,12 +2,118 @@
 Functions dealing with application specific password generation and handling
 """
 
+import hashlib
+import hmac
+import logging
+import math
+import secrets
+import threading
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
 from passlib.hash import sha512_crypt as sha512
+from sqlalchemy import or_
 from xkcdpass import xkcd_password as xp
 
-from selfservice.utilities.keycloak import OTPAlreadyConfigured
+from selfservice.utilities.cache import TTLCache
 from selfservice.models import AppSpecificPassword
-from selfservice import db
+from selfservice import app, db
+
+LOG = logging.getLogger(__name__)
+
+HASH_PREFIX = "{SHA512-CRYPT}"
+
+
+class VerificationBusy(Exception):
+    """
+    Error raised when a user already has as many verifications running as
+    allowed and none finished in time.
+    """
+
+    pass
+
+
+class LookupKeyMissing(Exception):
+    """
+    Error raised when app passwords are created or verified while
+    APP_PASSWD_LOOKUP_KEY is not set.
+    """
+
+    pass
+
+
+class TooManyAppPasswords(Exception):
+    """
+    Error raised when a user already has APP_PASSWD_MAX_PER_USER app
+    specific passwords.
+    """
+
+    pass
+
+
+class WordList:
+    """
+    The xkcdpass dictionary filtered to words of min_length to max_length
+    letters, read from disk once per process on first use. Words are kept
+    in one bytes buffer indexed by an array of offsets rather than as
+    thousands of str objects.
+
+    Keyword arguments:
+    min_length -- Shortest word kept
+    max_length -- Longest word kept
+    """
+
+    def __init__(self, min_length=5, max_length=8):
+        self.min_length = min_length
+        self.max_length = max_length
+        self._lock = threading.Lock()
+        self._buffer = None
+        self._offsets = None
+
+    def _load(self):
+        """
+        Read and filter the word file, unless already done.
+        """
+        if self._offsets is not None:
+            return
+        with self._lock:
+            if self._offsets is not None:
+                return
+            words = sorted(
+                xp.generate_wordlist(
+                    wordfile=xp.locate_wordfile(),
+                    min_length=self.min_length,
+                    max_length=self.max_length,
+                )
+            )
+            encoded = [word.encode() for word in words]
+            offsets = array("I", [0])
+            for word in encoded:
+                offsets.append(offsets[-1] + len(word))
+            self._buffer = b"".join(encoded)
+            self._offsets = offsets
+
+    def __len__(self):
+        self._load()
+        return len(self._offsets) - 1
+
+    def choose(self):
+        """
+        Pick a word uniformly at random with a CSPRNG.
+        """
+        self._load()
+        index = secrets.randbelow(len(self._offsets) - 1)
+        return self._buffer[self._offsets[index] : self._offsets[index + 1]].decode()
+
+    def entropy(self, count):
+        """
+        Bits of entropy in count words drawn independently from this list.
+        """
+        return count * math.log2(len(self))
+
+
+wordlist = WordList()
 
 
 def _generate_passwd(length=4):
@@ -17,9 +123,13 @@ def _generate_passwd(length=4):
     Keyword arguments:
     length -- Number of words to have in password
     """
-    wordfile = xp.locate_wordfile()
-    mywords = xp.generate_wordlist(wordfile=wordfile, min_length=5, max_length=8)
-    return xp.generate_xkcdpassword(mywords, delimiter="-", numwords=length)
+    password = "-".join(wordlist.choose() for _ in range(length))
+    LOG.info(
+        "Generated app password of %d words with %.1f bits of entropy",
+        length,
+        wordlist.entropy(length),
+    )
+    return password
 
 
 def _hash_passwd(password):
@@ -29,38 +139,229 @@ def _hash_passwd(password):
     Keyword arguments:
     password -- Key to hash
     """
-    pwhash = sha512.hash(password)
-    return "{SHA512-CRYPT}" + pwhash
+    pwhash = sha512.using(rounds=app.config["APP_PASSWD_ROUNDS"]).hash(password)
+    return HASH_PREFIX + pwhash
 
 
-def set_app_passwd(username):
+def _lookup_tag(username, password):
     """
-    Generate a random password, hash and store it, then return the original
-    password.
+    Short keyed tag stored beside each hash, so a login only verifies the
+    user's hashes that could match instead of every one of them. At 16 bits
+    it narrows the search without telling anyone much about the password.
+
+    Keyword arguments:
+    username -- Owner of the password
+    password -- Password in clear text
+    """
+    if not app.config["APP_PASSWD_LOOKUP_KEY"]:
+        raise LookupKeyMissing()
+    key = app.config["APP_PASSWD_LOOKUP_KEY"].encode()
+    message = username.encode() + b"\0" + password.encode()
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:4]
+
+
+def set_app_passwd(username, label):
+    """
+    Generate a random password, hash and store it under label, then return
+    the original password along with its row.
 
     Keyword arguments:
     username -- User who will be assigned the new password
+    label -- Name of the client the password is for
     """
-    has_passwd = AppSpecificPassword.query.filter_by(user=username).first()
-    if has_passwd:
-        raise OTPAlreadyConfigured
+    count = AppSpecificPassword.query.filter_by(user=username).count()
+    if count >= app.config["APP_PASSWD_MAX_PER_USER"]:
+        raise TooManyAppPasswords
 
     password = _generate_passwd()
-    hashed = _hash_passwd(password)
-
-    app_passwd = AppSpecificPassword(user=username, password=hashed)
+    app_passwd = AppSpecificPassword(
+        user=username,
+        label=label,
+        hash=_hash_passwd(password),
+        lookup=_lookup_tag(username, password),
+    )
     db.session.add(app_passwd)
     db.session.commit()
 
-    return password
+    return password, app_passwd
+
+
+def list_app_passwds(username):
+    """
+    All of a user's App Specific Passwords, oldest first
+
+    Keyword arguments:
+    username -- User who's app passwords will be listed
+    """
+    return (
+        AppSpecificPassword.query.filter_by(user=username)
+        .order_by(AppSpecificPassword.id)
+        .all()
+    )
+
+
+def revoke_app_passwd(username, passwd_id):
+    """
+    Deletes one App Specific Password, returning whether it existed
+
+    Keyword arguments:
+    username -- User who owns the password
+    passwd_id -- ID of the password to delete
+    """
+    deleted = AppSpecificPassword.query.filter_by(user=username, id=passwd_id).delete()
+    db.session.commit()
+    return bool(deleted)
 
 
 def delete_app_passwd(username):
     """
-    Deletes an existing App Specific Password
+    Deletes every App Specific Password a user has
 
     Keyword arguments:
-    username -- User who's app password will be deleted
+    username -- User who's app passwords will be deleted
     """
     AppSpecificPassword.query.filter_by(user=username).delete()
     db.session.commit()
+
+
+class UserSlots:
+    """
+    Caps how many verifications run at once for each user, so a burst of
+    reconnects from one mail client cannot occupy every worker thread with
+    hashing. Slots only exist while someone holds or waits for them.
+
+    Keyword arguments:
+    limit -- Concurrent verifications allowed per user
+    timeout -- Seconds to wait for a slot before giving up
+    """
+
+    def __init__(self, limit=1, timeout=5):
+        self.limit = limit
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    @contextmanager
+    def hold(self, user):
+        """
+        Hold one of user's slots for the duration of a with block. Raises
+        VerificationBusy if none became free in time.
+        """
+        with self._lock:
+            slot = self._slots.setdefault(
+                user, [threading.BoundedSemaphore(self.limit), 0]
+            )
+            slot[1] += 1
+        try:
+            if not slot[0].acquire(timeout=self.timeout):
+                raise VerificationBusy()
+            try:
+                yield
+            finally:
+                slot[0].release()
+        finally:
+            with self._lock:
+                slot[1] -= 1
+                if not slot[1]:
+                    del self._slots[user]
+
+
+# Successful checks, keyed by an HMAC of the credentials under a key that
+# never leaves this process, mapped to the hash they matched. A changed or
+# removed hash no longer matches, so revocation takes effect immediately.
+_cache_key = secrets.token_bytes(32)
+verified = TTLCache(
+    maxsize=app.config["APP_PASSWD_CACHE_SIZE"], ttl=app.config["APP_PASSWD_CACHE_TTL"]
+)
+user_slots = UserSlots(
+    limit=app.config["APP_PASSWD_USER_CONCURRENCY"],
+    timeout=app.config["APP_PASSWD_VERIFY_WAIT"],
+)
+
+
+def _credential_key(username, password):
+    """
+    Cache key for a username and password pair.
+    """
+    message = username.encode() + b"\0" + password.encode()
+    return hmac.new(_cache_key, message, hashlib.sha256).digest()
+
+
+def _touch(app_passwd):
+    """
+    Record that a password was used, at most once per
+    APP_PASSWD_TOUCH_INTERVAL so busy clients don't write on every login.
+    """
+    now = datetime.utcnow()
+    interval = timedelta(seconds=app.config["APP_PASSWD_TOUCH_INTERVAL"])
+    if app_passwd.last_used and now - app_passwd.last_used < interval:
+        return
+    AppSpecificPassword.query.filter(
+        AppSpecificPassword.id == app_passwd.id,
+        or_(
+            AppSpecificPassword.last_used.is_(None),
+            AppSpecificPassword.last_used < now - interval,
+        ),
+    ).update({"last_used": now}, synchronize_session=False)
+    db.session.commit()
+
+
+def _match(candidates, username, password, key):
+    """
+    The candidate password matches, checked against the cache first and then
+    by hash while holding one of the user's slots. None if nothing matches.
+    """
+    cached = verified.get(key, "")
+    for app_passwd in candidates:
+        if hmac.compare_digest(cached, app_passwd.hash):
+            return app_passwd
+
+    with user_slots.hold(username):
+        # A request that held the slot before us may have verified the same
+        # credentials already.
+        cached = verified.get(key, "")
+        for app_passwd in candidates:
+            if hmac.compare_digest(cached, app_passwd.hash):
+                return app_passwd
+        for app_passwd in candidates:
+            try:
+                if sha512.verify(password, app_passwd.hash[len(HASH_PREFIX) :]):
+                    verified.set(key, app_passwd.hash)
+                    return app_passwd
+            except ValueError:
+                LOG.warning("Malformed app password hash %d", app_passwd.id)
+    return None
+
+
+def verify_app_passwd(username, password):
+    """
+    Check a password against the user's app specific passwords. Only hashes
+    whose lookup tag matches, or which predate tags, are considered. Recent
+    successes are answered from the cache; otherwise the hashes are verified
+    while holding one of the user's slots.
+
+    Keyword arguments:
+    username -- User logging in
+    password -- Password they presented
+    """
+    candidates = [
+        app_passwd
+        for app_passwd in AppSpecificPassword.query.filter(
+            AppSpecificPassword.user == username,
+            or_(
+                AppSpecificPassword.lookup == _lookup_tag(username, password),
+                AppSpecificPassword.lookup.is_(None),
+            ),
+        ).order_by(AppSpecificPassword.lookup.is_(None))
+        if app_passwd.hash.startswith(HASH_PREFIX)
+    ]
+    if not candidates:
+        return False
+
+    app_passwd = _match(
+        candidates, username, password, _credential_key(username, password)
+    )
+    if not app_passwd:
+        return False
+    _touch(app_passwd)
+    return True
@@ -0,0 +1,96 @@
+"""
+Instrumentation for the SQLAlchemy connection pool.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """
+    Counters for one process's database connection pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.wait_seconds = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds):
+        """
+        Record how long a checkout waited for a connection.
+        """
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record(self, counter):
+        """
+        Increment the named counter.
+        """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+stats = PoolStats()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited, including the
+    time spent opening a new connection.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            stats.record_wait(time.perf_counter() - started)
+
+
+def instrument(engine):
+    """
+    Count connections opened and invalidated by engine's pool.
+
+    Keyword arguments:
+    engine -- SQLAlchemy Engine to watch
+    """
+    event.listen(engine, "connect", lambda *_: stats.record("connects"))
+    event.listen(engine, "invalidate", lambda *_: stats.record("invalidations"))
+    event.listen(engine, "soft_invalidate", lambda *_: stats.record("invalidations"))
+
+
+def pool_stats(engine):
+    """
+    Report the current state of engine's pool along with the counters since
+    this process started.
+
+    Keyword arguments:
+    engine -- SQLAlchemy Engine to report on
+    """
+    pool = engine.pool
+    report = {
+        "connects": stats.connects,
+        "checkouts": stats.checkouts,
+        "invalidations": stats.invalidations,
+        "wait_seconds": stats.wait_seconds,
+        "wait_max": stats.wait_max,
+    }
+    if isinstance(pool, QueuePool):
+        report.update(
+            {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(0, pool.overflow()),
+            }
+        )
+    return report
@@ -0,0 +1,272 @@
+"""
+Queued, asynchronous delivery of recovery emails and SMS messages.
+
+Messages are written to the outbound_message table and sent by a small pool
+of worker threads in each process, so a slow MTA or Twilio call never holds
+up a request.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from twilio.rest import Client
+
+from selfservice.models import OutboundMessage
+from selfservice.utilities.metrics import instrumented
+from selfservice.utilities.smtp import SMTPPool, make_message
+from selfservice import app, db
+
+LOG = logging.getLogger(__name__)
+
+# How long a claimed message may stay in "sending" before another worker
+# assumes its sender died and picks it up again.
+SEND_LEASE = timedelta(minutes=5)
+
+smtp_pool = SMTPPool(
+    app.config["SMTP_HOST"],
+    app.config["SMTP_PORT"],
+    size=app.config["SMTP_POOL_SIZE"],
+    timeout=app.config["SMTP_TIMEOUT"],
+    starttls=app.config["SMTP_STARTTLS"],
+    username=app.config["SMTP_USERNAME"],
+    password=app.config["SMTP_PASSWORD"],
+    max_messages=app.config["SMTP_MAX_MESSAGES"],
+)
+
+
+class SMTPTransport:
+    """
+    Sends email through the shared SMTP connection pool.
+    """
+
+    @instrumented("smtp")
+    def send(self, message):
+        """
+        Send an OutboundMessage as an email.
+        """
+        smtp_pool.send(
+            make_message(
+                app.config["MAIL_FROM"],
+                message.recipient,
+                message.subject,
+                message.body,
+            )
+        )
+
+    def close(self):
+        """
+        Pooled connections outlive any one worker.
+        """
+        pass
+
+
+class TwilioTransport:
+    """
+    Sends SMS through a single, reused Twilio client.
+    """
+
+    def __init__(self):
+        self._client = Client(app.config["TWILIO_SID"], app.config["TWILIO_TOKEN"])
+
+    @instrumented("twilio")
+    def send(self, message):
+        """
+        Send an OutboundMessage as an SMS.
+        """
+        self._client.messages.create(
+            to=message.recipient,
+            from_=app.config["TWILIO_NUMBER"],
+            body=message.body,
+            messaging_service_sid=app.config["TWILIO_SERVICE_SID"],
+        )
+
+    def close(self):
+        """
+        Twilio keeps no connection that needs closing.
+        """
+        pass
+
+
+class LogTransport:
+    """
+    Fake transport that only logs and remembers what it would have sent.
+    Used for SMS in development and tests.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        """
+        Record an OutboundMessage instead of sending it.
+        """
+        LOG.info(
+            "Would send %s to %s: %s", message.channel, message.recipient, message.body
+        )
+        self.sent.append((message.channel, message.recipient, message.body))
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+        pass
+
+
+def _build_transports():
+    """
+    Create one transport per channel for a worker thread.
+    """
+    if app.config["SMS_TRANSPORT"] == "twilio":
+        sms = TwilioTransport()
+    else:
+        sms = LogTransport()
+    return {"email": SMTPTransport(), "sms": sms}
+
+
+def _claim(batch_size):
+    """
+    Lock and lease up to batch_size due messages. SKIP LOCKED lets workers in
+    every process share the queue without handing out a message twice.
+    """
+    now = datetime.utcnow()
+    messages = (
+        OutboundMessage.query.filter(
+            OutboundMessage.status.in_(["queued", "sending"]),
+            OutboundMessage.next_attempt <= now,
+        )
+        .order_by(OutboundMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    for message in messages:
+        message.status = "sending"
+        message.attempts += 1
+        message.next_attempt = now + SEND_LEASE
+    db.session.commit()
+    return messages
+
+
+def _deliver(message, transports):
+    """
+    Send one claimed message and record the outcome.
+    """
+    try:
+        transports[message.channel].send(message)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        LOG.warning("Delivery of message %s failed: %r", message.id, e)
+        message.last_error = repr(e)
+        if message.attempts >= app.config["DELIVERY_MAX_ATTEMPTS"]:
+            message.status = "failed"
+        else:
+            backoff = app.config["DELIVERY_RETRY_BACKOFF"] * 2 ** (message.attempts - 1)
+            message.status = "queued"
+            message.next_attempt = datetime.utcnow() + timedelta(seconds=backoff)
+    else:
+        message.status = "sent"
+        message.sent = datetime.utcnow()
+    db.session.commit()
+
+
+class DeliveryWorkers:
+    """
+    Pool of threads draining the outbound message queue for this process.
+    Each thread owns its transports, so the Twilio client is reused across
+    messages; SMTP sessions come from the shared pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def _run(self):
+        """
+        Worker loop: sleep until woken or the poll interval passes, then
+        drain every due message.
+        """
+        transports = _build_transports()
+        while True:
+            self._wake.wait(app.config["DELIVERY_POLL_INTERVAL"])
+            self._wake.clear()
+            try:
+                with app.app_context():
+                    while True:
+                        messages = _claim(app.config["DELIVERY_BATCH_SIZE"])
+                        if not messages:
+                            break
+                        for message in messages:
+                            _deliver(message, transports)
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOG.exception("Delivery worker failed")
+
+    def start(self):
+        """
+        Start the worker threads if they are not running in this process.
+        """
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for index in range(app.config["DELIVERY_WORKERS"] - len(self._threads)):
+                thread = threading.Thread(
+                    target=self._run, name=f"delivery-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def wake(self):
+        """
+        Tell idle workers that a message is waiting.
+        """
+        self.start()
+        self._wake.set()
+
+
+workers = DeliveryWorkers()
+
+
+def enqueue(channel, recipient, body, subject=None, session=None):
+    """
+    Queue a message for delivery and return it.
+
+    Keyword arguments:
+    channel -- "email" or "sms"
+    recipient -- Email address or phone number
+    body -- Message text
+    subject -- Email subject line
+    session -- ID of the RecoverySession the message belongs to
+    """
+    message = OutboundMessage(
+        channel=channel,
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        session=session,
+        status="queued",
+        attempts=0,
+        next_attempt=datetime.utcnow(),
+    )
+    db.session.add(message)
+    db.session.commit()
+    workers.wake()
+    return message
+
+
+def delivery_status(session):
+    """
+    List the delivery state of every message queued for a recovery session.
+
+    Keyword arguments:
+    session -- ID of the RecoverySession
+    """
+    return [
+        {
+            "id": message.id,
+            "channel": message.channel,
+            "status": message.status,
+            "attempts": message.attempts,
+        }
+        for message in OutboundMessage.query.filter_by(session=session)
+        .order_by(OutboundMessage.id)
+        .all()
+    ]
@@ -0,0 +1,255 @@
+"""
+In-memory member directory backing the admin page.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import ldap as pyldap
+from ldap.controls import SimplePagedResultsControl
+
+from selfservice.utilities.metrics import timed
+
+LOG = logging.getLogger(__name__)
+
+USERS_BASE = "cn=users,cn=accounts,dc=csh,dc=rit,dc=edu"
+
+Snapshot = namedtuple("Snapshot", ["members", "index"])
+
+
+class DirectoryUnavailable(Exception):
+    """
+    Error raised when the member list has not been loaded yet, either because
+    the first load is still running or because it failed.
+    """
+
+    pass
+
+
+def _decode(attrs):
+    """
+    Turn a raw LDAP entry into the value/display pair used by the UI.
+    """
+    uid = attrs["uid"][0].decode("utf-8")
+    return {
+        "value": uid,
+        "display": attrs.get("displayName", attrs["uid"])[0].decode("utf-8"),
+    }
+
+
+class MemberIndex:
+    """
+    Case-insensitive search index over the uid and displayName of each
+    member. Keys are kept sorted so prefix matches are a binary search;
+    substring matches fall back to a scan of the same keys.
+
+    Keyword arguments:
+    members -- List of member dicts as built by the directory
+    """
+
+    def __init__(self, members):
+        keys = sorted(
+            (key.lower(), position)
+            for position, member in enumerate(members)
+            for key in (member["value"], member["display"])
+        )
+        self._members = members
+        self._keys = [key for key, _ in keys]
+        self._positions = [position for _, position in keys]
+
+        # All keys joined into one string so substring matching runs in C;
+        # _starts maps an offset in it back to a key.
+        self._haystack = "\n".join(self._keys)
+        self._starts = []
+        offset = 0
+        for key in self._keys:
+            self._starts.append(offset)
+            offset += len(key) + 1
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit members whose uid or display name starts with
+        query, followed by ones that merely contain it.
+
+        Keyword arguments:
+        query -- Text typed by the user
+        limit -- Maximum number of results
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+
+        found = []
+        key = bisect_left(self._keys, query)
+        while (
+            key < len(self._keys)
+            and len(found) < limit
+            and self._keys[key].startswith(query)
+        ):
+            if self._positions[key] not in found:
+                found.append(self._positions[key])
+            key += 1
+
+        offset = self._haystack.find(query)
+        while offset != -1 and len(found) < limit:
+            key = bisect_right(self._starts, offset) - 1
+            if self._positions[key] not in found:
+                found.append(self._positions[key])
+            # Skip to the next key so one key is not matched twice.
+            offset = self._haystack.find(
+                query, self._starts[key] + len(self._keys[key])
+            )
+
+        return [self._members[position] for position in found]
+
+
+class MemberDirectory:
+    """
+    Keeps the member list in memory. The list is loaded once with paged
+    searches (RFC 2696) by a background thread, which then only fetches
+    entries whose modifyTimestamp moved. A periodic full reload picks up
+    deleted accounts.
+
+    Keyword arguments:
+    ldap -- CSHLDAP instance to search with
+    interval -- Seconds between incremental refreshes
+    full_interval -- Seconds between full reloads
+    page_size -- Entries requested per page
+    """
+
+    def __init__(self, ldap, *, interval=60, full_interval=3600, page_size=500):
+        self.ldap = ldap
+        self.interval = interval
+        self.full_interval = full_interval
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._attempted = threading.Event()
+        self._thread = None
+        self._entries = {}
+        self._last_modified = None
+        self._last_full = None
+        self._snapshot = None
+
+    def _search(self, filterstr):
+        """
+        Run a paged subtree search under the users container.
+        """
+        conn = self.ldap.get_con()
+        control = SimplePagedResultsControl(True, size=self.page_size, cookie="")
+        while True:
+            with timed("ldap", "search_members"):
+                msgid = conn.search_ext(
+                    USERS_BASE,
+                    pyldap.SCOPE_SUBTREE,
+                    filterstr,
+                    ["uid", "displayName", "modifyTimestamp"],
+                    serverctrls=[control],
+                )
+                _, data, _, controls = conn.result3(msgid)
+            for dn, attrs in data:
+                if dn and "uid" in attrs:
+                    yield attrs
+
+            cookies = [
+                ctrl.cookie
+                for ctrl in controls
+                if ctrl.controlType == SimplePagedResultsControl.controlType
+            ]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
+    def _apply(self, entries, results, last_modified):
+        """
+        Merge search results into entries and return the newest
+        modifyTimestamp seen, which is the server's clock and not ours.
+        """
+        for attrs in results:
+            member = _decode(attrs)
+            entries[member["value"]] = member
+            stamp = attrs.get("modifyTimestamp", [b""])[0].decode("utf-8")
+            if stamp and (not last_modified or stamp > last_modified):
+                last_modified = stamp
+        return last_modified
+
+    def _publish(self):
+        """
+        Swap in a new sorted snapshot along with its search index.
+        """
+        members = sorted(self._entries.values(), key=lambda m: m["value"])
+        self._snapshot = Snapshot(members, MemberIndex(members))
+
+    def refresh(self, full=False):
+        """
+        Reload the whole directory, or only entries changed since the last
+        refresh.
+
+        Keyword arguments:
+        full -- Force a full reload
+        """
+        with self._lock:
+            # Work on a copy so a failed search leaves the old data in place.
+            if full or not self._last_modified:
+                entries = {}
+                last_modified = self._apply(entries, self._search("(uid=*)"), None)
+                self._last_full = time.monotonic()
+            else:
+                entries = dict(self._entries)
+                last_modified = self._apply(
+                    entries,
+                    self._search(f"(&(uid=*)(modifyTimestamp>={self._last_modified}))"),
+                    self._last_modified,
+                )
+            self._entries = entries
+            self._last_modified = last_modified
+            self._publish()
+
+    def _run(self):
+        """
+        Background refresh loop.
+        """
+        while True:
+            try:
+                self.refresh(
+                    full=self._last_full is None
+                    or time.monotonic() - self._last_full >= self.full_interval
+                )
+            except pyldap.LDAPError:
+                LOG.exception("Failed to refresh member directory")
+            finally:
+                self._attempted.set()
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Start the background refresh thread for this process if needed.
+        """
+        # Threads do not survive a fork, so this also restarts the loop in
+        # each worker.
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="member-directory", daemon=True
+            )
+            self._thread.start()
+
+    def snapshot(self, timeout=0.5):
+        """
+        Return the current Snapshot of the directory. Until the first load in
+        this process has been attempted, calls wait up to timeout seconds for
+        it; once it has failed they do not wait at all.
+
+        Keyword arguments:
+        timeout -- Seconds to wait for the initial load
+        """
+        self.start()
+        self._attempted.wait(timeout)
+        if self._snapshot is None:
+            raise DirectoryUnavailable()
+        return self._snapshot
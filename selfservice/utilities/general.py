@@ -2,13 +2,9 @@
 General helper funtions that reduce copied code.
 """
 
-import smtplib
-
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.utils import formatdate
-from twilio.rest import Client
-from flask import current_app
+
+from selfservice.utilities.delivery import enqueue
 
 
 def is_expired(timestamp, minutes):
@@ -24,9 +20,37 @@ def is_expired(timestamp, minutes):
     return expired
 
 
-def email_recovery(username, address, token):
+def request_text(params, key):
+    """
+    Read a string field from a JSON body or form, or None if it is missing,
+    not a string, or cannot be encoded as UTF-8 (e.g. a lone surrogate).
+
+    Keyword arguments:
+    params -- the parsed request body
+    key -- the field to read
+    """
+
+    if not hasattr(params, "get"):
+        return None
+    value = params.get(key, "")
+    if not isinstance(value, str):
+        return None
+    try:
+        value.encode()
+    except UnicodeEncodeError:
+        return None
+    return value
+
+
+def email_recovery(username, address, token, session=None):
     """
-    Send verification emails based on below template.
+    Queue verification emails based on below template.
+
+    Keyword arguments:
+    username -- Account being recovered
+    address -- Email address to send to
+    token -- Reset token to include in the link
+    session -- ID of the RecoverySession the email belongs to
     """
     message = (
         "Hey there!\n\n\tWe just received a request to reset "
@@ -45,35 +69,23 @@ def email_recovery(username, address, token):
 
     message = message.format(username, address, token)
 
-    email = MIMEText(message)
-    email["To"] = address
-    email["From"] = "CSH Account Recovery <rtp@csh.rit.edu>"
-    email["Subject"] = "Your Requested Account Reset"
-    email["Date"] = formatdate()
-
-    server = smtplib.SMTP("mail.csh.rit.edu")
-    server.send_message(email)
-    server.quit()
+    enqueue(
+        "email",
+        address,
+        message,
+        subject="Your Requested Account Reset",
+        session=session,
+    )
 
 
-def phone_recovery(phone, token):
-    """
-    Use Twilio to send token.
+def phone_recovery(phone, token, session=None):
     """
-    from_number = current_app.config.get("TWILIO_NUMBER")
-    service_sid = current_app.config.get("TWILIO_SERVICE_SID")
-    client = Client(
-        current_app.config.get("TWILIO_SID"), current_app.config.get("TWILIO_TOKEN")
-    )
-
-    # REMOVE ME
-    client.http_client.logger = current_app.logger
-    print(f"twilio client: {client}")
-    # REMOVE ME
+    Queue an SMS with the verification PIN.
 
+    Keyword arguments:
+    phone -- Phone number to send to
+    token -- PIN to send
+    session -- ID of the RecoverySession the SMS belongs to
+    """
     body = f"Your CSH account recovery PIN is: {token}"
-
-    m = client.messages.create(
-        to=phone, from_=from_number, body=body, messaging_service_sid=service_sid
-    )
-    print(m)
+    enqueue("sms", phone, body, session=session)
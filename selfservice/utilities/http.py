@@ -0,0 +1,110 @@
+"""
+Shared, pooled HTTP client used for all outbound REST calls.
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from selfservice import app
+
+# Only methods that are safe to repeat are retried automatically.
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def _build_session():
+    """
+    Create a requests session with a keep-alive connection pool per host and
+    bounded retries for idempotent calls.
+    """
+    retries = Retry(
+        total=app.config["HTTP_RETRIES"],
+        backoff_factor=app.config["HTTP_RETRY_BACKOFF"],
+        status_forcelist=(502, 503, 504),
+        allowed_methods=IDEMPOTENT_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=app.config["HTTP_POOL_CONNECTIONS"],
+        pool_maxsize=app.config["HTTP_POOL_MAXSIZE"],
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Return this worker's shared session. Sockets must not be shared across a
+    fork, so a new session is built when the process ID changes.
+    """
+    global _session, _session_pid  # pylint: disable=global-statement
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the shared session.
+
+    Keyword arguments:
+    method -- HTTP method to use
+    url -- Full URL of the endpoint
+    kwargs -- Passed through to requests; timeout defaults to the configured
+              (connect, read) pair
+    """
+    kwargs.setdefault(
+        "timeout", (app.config["HTTP_CONNECT_TIMEOUT"], app.config["HTTP_READ_TIMEOUT"])
+    )
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """
+    Send a GET request through the shared session.
+    """
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Send a POST request through the shared session.
+    """
+    return request("POST", url, **kwargs)
+
+
+def pool_stats():
+    """
+    Report connection pool usage for every host this worker has talked to.
+    """
+    stats = {}
+    adapter = get_session().get_adapter("https://")
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        # Unused slots in the pool queue are None placeholders.
+        idle = [conn for conn in list(pool.pool.queue) if conn] if pool.pool else []
+        stats[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+            "created": pool.num_connections,
+            "requests": pool.num_requests,
+            "idle": len(idle),
+            "maxsize": pool.pool.maxsize if pool.pool else 0,
+        }
+    return stats
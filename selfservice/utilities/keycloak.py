@@ -4,17 +4,30 @@ Functions for interacting with the Keycloak service.
 
 import json
 import logging
+import threading
+import time
+from datetime import timedelta
 
-from keycloak import KeycloakAdmin, KeycloakOpenID
-import requests
+from keycloak import KeycloakOpenID
+from keycloak.exceptions import KeycloakError
 import pyotp
+from sqlalchemy import func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.functions import now as sql_now
 
-from selfservice import app
+from selfservice.models import KeycloakUserEviction
+from selfservice.utilities import http
+from selfservice.utilities.cache import TTLCache
+from selfservice.utilities.metrics import timed
+from selfservice import app, db
 
 LOG = logging.getLogger(__name__)
 
 DEVICE_NAME = "SelfService"
 
+KC_SERVER_URL = "https://sso.csh.rit.edu/auth/"
+
 
 class OTPInvalidCode(Exception):
     """
@@ -48,6 +61,14 @@ class OTPConfigError(Exception):
     pass
 
 
+class OTPUserNotFound(OTPConfigError):
+    """
+    Error for usernames that have no matching Keycloak account.
+    """
+
+    pass
+
+
 def generate_otp(secret):
     """
     Get current OTP for given secret.
@@ -57,42 +78,270 @@ def generate_otp(secret):
     return code
 
 
-def get_kc_user_id(username):
+class KeycloakTokenCache:
     """
-    Login as Keycloak Admin and Impersonate User
+    Process-wide holder for a single Keycloak access token. The token is
+    reused until shortly before it expires, then renewed with the refresh
+    token if one was issued, falling back to a fresh grant otherwise.
 
     Keyword arguments:
-    username -- Username of account to generate secret for
+    openid -- KeycloakOpenID client for the realm issuing the token
+    grant -- Keyword arguments passed to KeycloakOpenID.token()
+    leeway -- Seconds before expiry at which the token is renewed
     """
-    admin = KeycloakAdmin(
-        server_url="https://sso.csh.rit.edu/auth/",
-        username=app.config["KC_ADMIN_USER"],
-        password=app.config["KC_ADMIN_PW"],
+
+    def __init__(self, openid, grant, leeway=30):
+        self._openid = openid
+        self._grant = grant
+        self._leeway = leeway
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._refresh_token = None
+        self._expires = 0
+        self._refresh_expires = 0
+
+    def get(self):
+        """
+        Return a valid access token, renewing it if necessary.
+        """
+        # KeycloakOpenID mutates shared headers while requesting a token, so
+        # renewals are serialized under the same lock as the cached value.
+        with self._lock:
+            now = time.monotonic()
+            if self._access_token and now < self._expires:
+                return self._access_token
+
+            token = None
+            if self._refresh_token and now < self._refresh_expires:
+                try:
+                    with timed("keycloak", "refresh_token"):
+                        token = self._openid.refresh_token(self._refresh_token)
+                except KeycloakError:
+                    LOG.warning("Keycloak token refresh failed, requesting new grant")
+
+            if token is None:
+                with timed("keycloak", "token"):
+                    token = self._openid.token(**self._grant)
+
+            self._access_token = token["access_token"]
+            self._expires = now + token.get("expires_in", 0) - self._leeway
+            self._refresh_token = token.get("refresh_token")
+            self._refresh_expires = (
+                now + token.get("refresh_expires_in", 0) - self._leeway
+            )
+            return self._access_token
+
+    def invalidate(self):
+        """
+        Drop the cached token, e.g. after the server rejected it.
+        """
+        with self._lock:
+            self._access_token = None
+            self._expires = 0
+
+
+admin_tokens = KeycloakTokenCache(
+    KeycloakOpenID(
+        server_url=KC_SERVER_URL,
         realm_name="master",
+        client_id="admin-cli",
         verify=True,
-    )
-    conn = admin.connection
-    user = conn.raw_get(
-        f"admin/realms/csh/users?first=0&max=20&search={username}@csh.rit.edu"
-    )
-    user_id = json.loads(user.text)[0]["id"]
-    return user_id
+    ),
+    grant={
+        "username": app.config["KC_ADMIN_USER"],
+        "password": app.config["KC_ADMIN_PW"],
+        "grant_type": "password",
+    },
+    leeway=app.config["KC_TOKEN_LEEWAY"],
+)
+
+service_tokens = KeycloakTokenCache(
+    KeycloakOpenID(
+        server_url=KC_SERVER_URL,
+        realm_name="csh",
+        client_id=app.config["OIDC_CLIENT_CONFIG"]["client_id"],
+        client_secret_key=app.config["OIDC_CLIENT_CONFIG"]["client_secret"],
+        verify=True,
+    ),
+    grant={"grant_type": "client_credentials"},
+    leeway=app.config["KC_TOKEN_LEEWAY"],
+)
+
+
+user_ids = TTLCache(
+    maxsize=app.config["KC_USER_CACHE_SIZE"], ttl=app.config["KC_USER_CACHE_TTL"]
+)
+_MISSING = object()
 
 
-def get_kc_service_account_token():
+class SharedEvictions:
     """
-    Get an auth token for the OIDC client's associated service account
+    Evictions from a cache that every gunicorn worker must see. An eviction
+    is written to the kc_user_evictions table; each worker reads the rows
+    newer than the last ones it saw at most once per interval seconds, while
+    using the cache, and drops those keys from its own copy. The table is
+    read and written on connections of its own, so callers' sessions are
+    left alone.
+
+    Keyword arguments:
+    cache -- TTLCache of this worker
+    interval -- Seconds between checks of the table
     """
 
-    keycloak_openid = KeycloakOpenID(
-        server_url="https://sso.csh.rit.edu/auth/",
-        realm_name="csh",
-        client_id=app.config["OIDC_CLIENT_CONFIG"]["client_id"],
-        client_secret_key=app.config["OIDC_CLIENT_CONFIG"]["client_secret"],
-        verify=True,
-    )
-    token = keycloak_openid.token(grant_type="client_credentials")
-    return token["access_token"]
+    OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, cache, interval=10):
+        self.cache = cache
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._started = False
+        self._since = None
+        self._seen = {}
+
+    def publish(self, username):
+        """
+        Record an eviction for every worker and apply it to this one at once.
+        Returns True if this worker had the username cached.
+        """
+        with db.engine.begin() as conn:
+            conn.execute(
+                insert(KeycloakUserEviction)
+                .values(username=username, evicted=func.timezone("UTC", sql_now()))
+                .on_conflict_do_update(
+                    index_elements=["username"],
+                    set_={"evicted": func.timezone("UTC", sql_now())},
+                )
+            )
+        return self.cache.evict(username)
+
+    def apply(self):
+        """
+        Drop keys other workers evicted since the last check, if it is due.
+        A failed check is logged and retried at the next interval, so lookups
+        keep working without the database.
+        """
+        if time.monotonic() - self._checked < self.interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._checked < self.interval:
+                return
+            self._checked = time.monotonic()
+            try:
+                with db.engine.connect() as conn:
+                    self._apply(conn)
+            except SQLAlchemyError:
+                LOG.warning("Could not check for Keycloak user evictions")
+
+    def _apply(self, conn):
+        """
+        Read new evictions and drop them from the cache.
+
+        Keyword arguments:
+        conn -- Connection to read the table with
+        """
+        if not self._started:
+            self._started = True
+            if len(self.cache) == 0:
+                # Nothing is cached yet, so only the newest time matters.
+                self._since = conn.execute(
+                    select(func.max(KeycloakUserEviction.evicted))
+                ).scalar()
+                return
+            # Earlier checks failed while lookups filled the cache, so every
+            # eviction still in the table may apply to it.
+
+        query = select(KeycloakUserEviction.username, KeycloakUserEviction.evicted)
+        if self._since is not None:
+            # Rows committed late may carry a slightly older time, so look
+            # back a little and skip the ones already applied.
+            query = query.where(
+                KeycloakUserEviction.evicted > self._since - self.OVERLAP
+            )
+        for username, evicted in conn.execute(query).all():
+            if self._seen.get(username) != evicted:
+                self._seen[username] = evicted
+                self.cache.evict(username)
+            self._since = max(self._since or evicted, evicted)
+        if self._since is not None:
+            cutoff = self._since - self.OVERLAP
+            self._seen = {k: v for k, v in self._seen.items() if v > cutoff}
+
+
+evictions = SharedEvictions(user_ids, interval=app.config["KC_EVICTION_POLL_INTERVAL"])
+
+
+def _kc_request(method, url, tokens, operation, **kwargs):
+    """
+    Send a request authenticated with a cached token, retrying once with a
+    new token if the cached one was rejected.
+
+    Keyword arguments:
+    method -- HTTP method to use
+    url -- Full URL of the endpoint
+    tokens -- KeycloakTokenCache supplying the bearer token
+    operation -- Name of the call, used to label its metrics
+    """
+    headers = kwargs.pop("headers", {})
+    headers["Authorization"] = f"Bearer {tokens.get()}"
+    with timed("keycloak", operation):
+        response = http.request(method, url, headers=headers, **kwargs)
+
+    if response.status_code == 401:
+        tokens.invalidate()
+        headers["Authorization"] = f"Bearer {tokens.get()}"
+        with timed("keycloak", operation):
+            response = http.request(method, url, headers=headers, **kwargs)
+
+    return response
+
+
+def get_kc_user_id(username):
+    """
+    Look up the Keycloak ID of a user with the cached admin token. IDs never
+    change for a username, so results (including misses) are cached.
+
+    Keyword arguments:
+    username -- Username of account to generate secret for
+    """
+    evictions.apply()
+    user_id = user_ids.get(username, _MISSING)
+    if user_id is _MISSING:
+        response = _kc_request(
+            "GET",
+            f"{KC_SERVER_URL}admin/realms/csh/users",
+            admin_tokens,
+            "get_user",
+            params={"username": username, "exact": "true"},
+        )
+        response.raise_for_status()
+        matches = [
+            user
+            for user in json.loads(response.text)
+            if user["username"].lower() == username.lower()
+        ]
+        if matches:
+            user_id = matches[0]["id"]
+            user_ids.set(username, user_id)
+        else:
+            user_id = None
+            user_ids.set(username, None, ttl=app.config["KC_USER_NEGATIVE_TTL"])
+
+    if user_id is None:
+        raise OTPUserNotFound()
+    return user_id
+
+
+def evict_kc_user_id(username):
+    """
+    Forget the cached Keycloak ID for a user in every worker. This worker
+    forgets it at once, the others within KC_EVICTION_POLL_INTERVAL seconds.
+    Returns whether this worker had it cached.
+
+    Keyword arguments:
+    username -- Username of account to evict
+    """
+    return evictions.publish(username)
 
 
 def get_kc_otp_is_registered(username):
@@ -103,11 +352,11 @@ def get_kc_otp_is_registered(username):
     username -- Username of account to check
     """
     user_id = get_kc_user_id(username)
-    token = get_kc_service_account_token()
-    response = requests.get(
+    response = _kc_request(
+        "GET",
         f"{app.config["OIDC_ISSUER"]}/totp-api/{user_id}/isRegistered/{DEVICE_NAME}",
-        headers={"Authorization": f"Bearer {token}"},
-        timeout=30,
+        service_tokens,
+        "otp_is_registered",
     )
     return response.ok
 
@@ -121,11 +370,11 @@ def generate_kc_otp(username):
     """
 
     user_id = get_kc_user_id(username)
-    token = get_kc_service_account_token()
-    response = requests.get(
+    response = _kc_request(
+        "GET",
         f"{app.config["OIDC_ISSUER"]}/totp-api/{user_id}/generate",
-        headers={"Authorization": f"Bearer {token}"},
-        timeout=30,
+        service_tokens,
+        "otp_generate",
     )
     response.raise_for_status()
     return response.json()["encodedSecret"]
@@ -140,21 +389,19 @@ def register_kc_otp(username, secret, otp_code):
     form_data -- Form validation information
     """
     user_id = get_kc_user_id(username)
-    token = get_kc_service_account_token()
 
-    response = requests.post(
+    response = _kc_request(
+        "POST",
         f"{app.config["OIDC_ISSUER"]}/totp-api/{user_id}/register",
-        headers={
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        },
+        service_tokens,
+        "otp_register",
+        headers={"Content-Type": "application/json"},
         json={
             "encodedSecret": secret,
             "initialCode": otp_code,
             "deviceName": DEVICE_NAME,
             "overwrite": False,
         },
-        timeout=30,
     )
     resp = response.json()
 
@@ -182,18 +429,16 @@ def delete_kc_otp(username):
     username -- Username of account to manipulate
     """
     user_id = get_kc_user_id(username)
-    token = get_kc_service_account_token()
 
-    response = requests.post(
+    response = _kc_request(
+        "POST",
         f"{app.config["OIDC_ISSUER"]}/totp-api/{user_id}/unregister",
-        headers={
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        },
+        service_tokens,
+        "otp_unregister",
+        headers={"Content-Type": "application/json"},
         json={
             "deviceName": DEVICE_NAME,
         },
-        timeout=30,
     )
     resp = response.json()
 
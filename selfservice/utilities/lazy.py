@@ -0,0 +1,85 @@
+"""
+Clients that are only created when first used, so importing selfservice
+does no network I/O.
+"""
+
+import os
+import threading
+
+from flask_pyoidc.flask_pyoidc import OIDCAuthentication
+from flask_pyoidc.pyoidc_facade import PyoidcFacade
+
+from selfservice.utilities.metrics import timed
+
+
+class Lazy:
+    """
+    Stands in for a client that connects somewhere when it is created.
+    The client is built by factory on first use and attribute and item
+    access is passed through to it. Sockets must not be shared across a
+    fork, so each process builds its own. If factory raises, the next use
+    tries again.
+
+    Keyword arguments:
+    factory -- Callable returning the client
+    dependency -- Service the client talks to, used to label its metrics
+    operation -- Metrics label for building the client
+    """
+
+    def __init__(self, factory, dependency, operation="connect"):
+        self._factory = factory
+        self._dependency = dependency
+        self._operation = operation
+        self._lock = threading.Lock()
+        self._target = None
+        self._pid = None
+
+    def get(self):
+        """
+        Return the client, building it if this process has none yet.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    with timed(self._dependency, self._operation):
+                        self._target = self._factory()
+                    self._pid = pid
+        return self._target
+
+    @property
+    def loaded(self):
+        """
+        Whether this process has built the client yet.
+        """
+        return self._pid == os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+
+class LazyOIDCAuthentication(OIDCAuthentication):
+    """
+    OIDCAuthentication that fetches the provider's discovery document on the
+    first login instead of when it is attached to the app.
+    """
+
+    def init_app(self, app):
+        # The parent registers the redirect route and builds a client per
+        # provider, which is what does the discovery request; hide the
+        # providers from it and build the clients on first use instead.
+        providers = self._provider_configurations
+        self._provider_configurations = {}
+        super().init_app(app)
+        self._provider_configurations = providers
+        self.clients = Lazy(
+            lambda: {
+                name: PyoidcFacade(configuration, self._redirect_uri_config.full_uri)
+                for name, configuration in providers.items()
+            },
+            "keycloak",
+            "discovery",
+        )
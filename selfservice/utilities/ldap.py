@@ -2,23 +2,48 @@
 Functions dealing with direct LDAP and FreeIPA communications.
 """
 
+import logging
 import re
-import ldap as pyldap
+import threading
 
+from python_freeipa.exceptions import FreeIPAError, Unauthorized
+
+from selfservice.utilities.directory import MemberDirectory
+from selfservice.utilities.metrics import timed
 from selfservice import app, ldap, ipa
 
+# In-memory copy of cn=users, refreshed in the background
+directory = MemberDirectory(
+    ldap,
+    interval=app.config["MEMBER_REFRESH_INTERVAL"],
+    full_interval=app.config["MEMBER_FULL_RELOAD_INTERVAL"],
+    page_size=app.config["LDAP_PAGE_SIZE"],
+)
+
+LOG = logging.getLogger(__name__)
+
+# The FreeIPA client holds its login in a single cookie jar, so a login and
+# the calls relying on it must not interleave with another thread's.
+ipa_lock = threading.Lock()
+# Client whose cookie jar holds a live session. Each process logs in once,
+# and again only when FreeIPA answers 401 because the session expired.
+_ipa_session = {"client": None}
 
-def verif_methods(username):
+
+def verif_methods(username, user=None):
     """
     Check LDAP for information about the provided user which could be used
     to verify their identity.
 
     Keyword arguments:
     username -- Username of account to lookup
+    user -- Already fetched CSHMember for username, if any
     """
     methods = {"email": [], "phone": [], "rit": None}
 
-    user = ldap.get_member(username, uid=True)
+    if user is None:
+        with timed("ldap", "get_member"):
+            user = ldap.get_member(username, uid=True)
 
     if user.mail:
         for addr in user.get("mail"):
@@ -46,29 +71,16 @@ def verif_methods(username):
     return methods
 
 
-def get_members():
+def search_members(query, limit=10):
     """
-    Get a list of all members in FreeIPA
+    Find members by uid or display name prefix or substring. Raises
+    DirectoryUnavailable while the member list is not loaded.
+
+    Keyword arguments:
+    query -- Text to search for
+    limit -- Maximum number of results
     """
-    members = []
-    ldap_conn = ldap.get_con()
-    res = ldap_conn.search_s(
-        "cn=users,cn=accounts,dc=csh,dc=rit,dc=edu",
-        pyldap.SCOPE_SUBTREE,
-        "(uid=*)",
-        ["uid", "displayName"],
-    )
-    for member in res:
-        members.append(
-            {
-                "value": member[1]["uid"][0].decode("utf-8"),
-                "display": member[1]
-                .get("displayName", member[1]["uid"])[0]
-                .decode("utf-8"),
-            }
-        )
-
-    return members
+    return directory.snapshot().index.search(query, limit)
 
 
 def ipa_login():
@@ -77,17 +89,52 @@ def ipa_login():
     """
     username = app.config["LDAP_BIND_DN"].split(",")[0].split("=")[1]
     password = app.config["LDAP_BIND_PW"]
-    ipa.login(username, password)
+    with timed("freeipa", "login"):
+        ipa.login(username, password)
+    _ipa_session["client"] = ipa.get()
+
+
+def ipa_request(method, args=None, params=None):
+    """
+    Make a FreeIPA JSON-RPC call on the shared session, logging in only if
+    there is no session yet or it has expired. Must hold ipa_lock.
+
+    Keyword arguments:
+    method -- JSON-RPC method name
+    args -- Positional arguments of the call
+    params -- Named options of the call
+    """
+    if _ipa_session["client"] is not ipa.get():
+        ipa_login()
+    try:
+        with timed("freeipa", method):
+            return ipa._request(method, args=args, params=params)
+    except Unauthorized:
+        LOG.info("FreeIPA session expired, logging in again")
+        ipa_login()
+        with timed("freeipa", method):
+            return ipa._request(method, args=args, params=params)
 
 
 def delete_ipa_otp(username):
     """
-    Remove all OTP tokens from the given user's account.
+    Remove all OTP tokens from the given user's account, in one batch call.
 
     Keyword arguments:
     username -- Username of account to lookup
     """
-    ipa_login()
-    token_info = ipa._request("otptoken_find", params={"ipatokenowner": username})
-    for token in token_info["result"]:
-        ipa._request("otptoken_del", args=[token["ipatokenuniqueid"][0]])
+    with ipa_lock:
+        token_info = ipa_request("otptoken_find", params={"ipatokenowner": username})
+        calls = [
+            {"method": "otptoken_del", "params": [[token["ipatokenuniqueid"][0]], {}]}
+            for token in token_info["result"]
+        ]
+        if not calls:
+            return
+        results = ipa_request("batch", args=[calls])
+
+    for result in results["results"]:
+        error = result.get("error")
+        # A token removed by someone else since the find is already gone.
+        if error and result.get("error_name") != "NotFound":
+            raise FreeIPAError(message=error, code=result.get("error_code"))
@@ -0,0 +1,183 @@
+"""
+Bounded pool of authenticated LDAPS connections to FreeIPA.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import ldap
+
+from selfservice.utilities.metrics import timed
+
+LOG = logging.getLogger(__name__)
+
+
+class LDAPPoolExhausted(Exception):
+    """
+    Error raised when no pooled connection became free in time.
+    """
+
+    pass
+
+
+class _PooledConnection:
+    """
+    An authenticated connection and the server it is bound to.
+    """
+
+    def __init__(self, conn, host):
+        self.conn = conn
+        self.host = host
+        self.last_used = time.monotonic()
+
+
+class LDAPConnectionPool:
+    """
+    Keeps up to size authenticated connections open across requests.
+    Connections are opened lazily against the healthy FreeIPA server picked
+    by the resolver, health-checked after sitting idle, and replaced when the
+    server goes away.
+
+    Keyword arguments:
+    servers -- SRVResolver handing out FreeIPA hosts
+    bind_dn -- DN to bind as
+    bind_pw -- Password for bind_dn
+    size -- Maximum number of open connections
+    timeout -- Network timeout for connecting and for operations, in seconds
+    idle_check -- Seconds of idleness after which a connection is checked
+    """
+
+    def __init__(self, servers, bind_dn, bind_pw, *, size=4, timeout=10, idle_check=60):
+        self.servers = servers
+        self.size = size
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._bind_dn = bind_dn
+        self._bind_pw = bind_pw
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _open(self, host):
+        """
+        Open and bind a new connection to host.
+        """
+        conn = ldap.initialize(f"ldaps://{host}")
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+        with timed("freeipa_ldap", "bind"):
+            conn.simple_bind_s(self._bind_dn, self._bind_pw)
+        return _PooledConnection(conn, host)
+
+    @staticmethod
+    def _discard(entry):
+        """
+        Unbind a connection that is leaving the pool.
+        """
+        try:
+            entry.conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _checkout(self, fresh=False):
+        """
+        Take an idle connection, or open a new one if none is usable.
+        Idle connections to a host marked unhealthy are dropped.
+
+        Keyword arguments:
+        fresh -- Skip the idle connections and open a new one
+        """
+        # Sockets opened before a fork belong to the parent process.
+        if self._pid != os.getpid():
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+
+        while not fresh:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+
+            if self.servers.is_unhealthy(entry.host):
+                self._discard(entry)
+                continue
+            if time.monotonic() - entry.last_used < self.idle_check:
+                return entry
+            try:
+                with timed("freeipa_ldap", "whoami"):
+                    entry.conn.whoami_s()
+                return entry
+            except ldap.LDAPError:
+                LOG.info("Dropping stale LDAP connection to %s", entry.host)
+                self._discard(entry)
+        return self.servers.failover(self._open, (ldap.SERVER_DOWN,))
+
+    @contextmanager
+    def connection(self, fresh=False):
+        """
+        Borrow a connection for the duration of a with block. Yields the
+        LDAPObject and the host it is bound to. A connection is only handed
+        back to the pool if the block finished or the server answered with an
+        LDAP error.
+
+        Keyword arguments:
+        fresh -- Open a new connection rather than reuse an idle one
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise LDAPPoolExhausted()
+        try:
+            entry = self._checkout(fresh)
+            try:
+                yield entry.conn, entry.host
+            except ldap.SERVER_DOWN:
+                self._discard(entry)
+                raise
+            except ldap.LDAPError:
+                # The server answered, so the connection is still usable.
+                entry.last_used = time.monotonic()
+                self._idle.put(entry)
+                raise
+            except Exception:
+                # Its state after an unexpected error is unknown.
+                self._discard(entry)
+                raise
+            entry.last_used = time.monotonic()
+            self._idle.put(entry)
+        finally:
+            self._slots.release()
+
+    def run(self, func, errors=(ldap.SERVER_DOWN,)):
+        """
+        Call func with a pooled connection and its host, retrying once on a
+        new connection, opened through failover, if the server turned out to
+        be unreachable.
+
+        Keyword arguments:
+        func -- Callable taking (conn, host)
+        errors -- Exception types that indicate the host is unreachable
+        """
+        for attempt in range(2):
+            try:
+                with self.connection(fresh=bool(attempt)) as (conn, host):
+                    try:
+                        return func(conn, host)
+                    except errors:
+                        self.servers.mark_unhealthy(host)
+                        raise
+            except errors:
+                if attempt:
+                    raise
+
+    def close(self):
+        """
+        Unbind every idle connection.
+        """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
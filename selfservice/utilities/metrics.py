@@ -0,0 +1,219 @@
+"""
+Prometheus metrics for requests and for calls to the services selfservice
+depends on.
+
+Under gunicorn every worker keeps its own counters. Setting
+PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers makes
+/metrics report the sum over all of them.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DEPENDENCY_LATENCY = Histogram(
+    "selfservice_dependency_duration_seconds",
+    "Latency of calls to external services",
+    ["dependency", "operation"],
+    buckets=BUCKETS,
+)
+DEPENDENCY_ERRORS = Counter(
+    "selfservice_dependency_errors_total",
+    "Calls to external services that raised",
+    ["dependency", "operation", "error"],
+)
+REQUEST_LATENCY = Histogram(
+    "selfservice_request_duration_seconds",
+    "Latency of requests served",
+    ["blueprint", "endpoint", "method", "status"],
+    buckets=BUCKETS,
+)
+POOL_CONNECTIONS = Gauge(
+    "selfservice_pool_connections",
+    "Connections held by outbound connection pools",
+    ["pool", "state"],
+    multiprocess_mode="livesum",
+)
+POOL_EVENTS = Gauge(
+    "selfservice_pool_events",
+    "Connections opened and handed out by outbound pools since start",
+    ["pool", "event"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT = Gauge(
+    "selfservice_db_pool_wait_seconds",
+    "Time spent waiting for a database connection since start",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT_MAX = Gauge(
+    "selfservice_db_pool_wait_max_seconds",
+    "Longest wait for a database connection since start",
+    multiprocess_mode="livemax",
+)
+PRUNED_ROWS = Counter(
+    "selfservice_pruned_rows_total",
+    "Expired rows deleted by flask prune",
+    ["table"],
+)
+PRUNE_DURATION = Counter(
+    "selfservice_prune_seconds_total",
+    "Time flask prune spent deleting from each table",
+    ["table"],
+)
+PRUNE_LAST_RUN = Gauge(
+    "selfservice_prune_last_run_timestamp_seconds",
+    "When flask prune last finished",
+    multiprocess_mode="max",
+)
+STARTUP_DURATION = Gauge(
+    "selfservice_startup_seconds",
+    "Time taken by each startup phase",
+    ["phase"],
+    multiprocess_mode="max",
+)
+
+
+@contextmanager
+def timed(dependency, operation):
+    """
+    Record the latency of the wrapped block, and its exception type if it
+    raises.
+
+    Keyword arguments:
+    dependency -- Service being called, e.g. "keycloak"
+    operation -- What is being asked of it, e.g. "get_user"
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        DEPENDENCY_ERRORS.labels(dependency, operation, type(e).__name__).inc()
+        raise
+    finally:
+        DEPENDENCY_LATENCY.labels(dependency, operation).observe(
+            time.perf_counter() - started
+        )
+
+
+def instrumented(dependency, operation=None):
+    """
+    Decorator form of timed, labelled with the function name by default.
+
+    Keyword arguments:
+    dependency -- Service being called
+    operation -- Operation label, defaults to the function name
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(dependency, operation or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_engine(engine):
+    """
+    Time every statement run by engine as the postgres dependency, labelled
+    with the SQL verb.
+
+    Keyword arguments:
+    engine -- SQLAlchemy Engine to watch
+    """
+
+    def before(conn, _cursor, _statement, _params, _context, _many):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    def after(conn, _cursor, statement, _params, _context, _many):
+        started = conn.info["metrics_started"].pop()
+        DEPENDENCY_LATENCY.labels("postgres", _verb(statement)).observe(
+            time.perf_counter() - started
+        )
+
+    def error(context):
+        started = (
+            context.connection.info.get("metrics_started")
+            if context.connection
+            else None
+        )
+        if started:
+            started.pop()
+        DEPENDENCY_ERRORS.labels(
+            "postgres",
+            _verb(context.statement or ""),
+            type(context.original_exception).__name__,
+        ).inc()
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    event.listen(engine, "handle_error", error)
+
+
+def _verb(statement):
+    """
+    First keyword of a SQL statement, e.g. "select".
+    """
+    words = statement.split(None, 1)
+    return words[0].lower() if words else "unknown"
+
+
+def observe_request(blueprint, endpoint, method, status, seconds):
+    """
+    Record one served request.
+    """
+    REQUEST_LATENCY.labels(
+        blueprint or "app", endpoint or "unknown", method, status
+    ).observe(seconds)
+
+
+def record_pools(http_stats, db_stats):
+    """
+    Copy the current HTTP and database pool stats of this worker into gauges.
+
+    Keyword arguments:
+    http_stats -- Result of http.pool_stats()
+    db_stats -- Result of db_pool.pool_stats()
+    """
+    for host, stats in http_stats.items():
+        POOL_CONNECTIONS.labels(host, "idle").set(stats["idle"])
+        POOL_EVENTS.labels(host, "created").set(stats["created"])
+        POOL_EVENTS.labels(host, "requests").set(stats["requests"])
+
+    for state in ("checked_out", "checked_in", "overflow"):
+        if state in db_stats:
+            POOL_CONNECTIONS.labels("postgres", state).set(db_stats[state])
+    for name in ("connects", "checkouts", "invalidations"):
+        POOL_EVENTS.labels("postgres", name).set(db_stats[name])
+    DB_POOL_WAIT.set(db_stats["wait_seconds"])
+    DB_POOL_WAIT_MAX.set(db_stats["wait_max"])
+
+
+def render():
+    """
+    Return the exposition body and its content type, aggregated over every
+    worker when running in multiprocess mode.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,146 @@
+"""
+Readiness probes for the services selfservice cannot work without.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from sqlalchemy import text
+
+from selfservice.utilities import http
+from selfservice.utilities.keycloak import KC_SERVER_URL
+from selfservice import app, db, ldap, ipa_ldap
+
+
+def probe_postgres():
+    """
+    Run a trivial query on a pooled database connection.
+    """
+    with app.app_context():
+        with db.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+
+def probe_ldap():
+    """
+    Check that the CSHLDAP bind is still accepted.
+    """
+    ldap.get_con().whoami_s()
+
+
+def probe_freeipa():
+    """
+    Check a pooled, bound connection to the FreeIPA host picked by SRV lookup.
+    Returns the host that answered.
+    """
+
+    def whoami(conn, host):
+        conn.whoami_s()
+        return host
+
+    return ipa_ldap.run(whoami)
+
+
+def probe_keycloak():
+    """
+    Fetch the realm's OpenID discovery document. It is served without
+    authentication, so probing does not cost Keycloak a token grant.
+    """
+    response = http.get(
+        f"{KC_SERVER_URL}realms/csh/.well-known/openid-configuration",
+        timeout=app.config["READY_PROBE_TIMEOUT"],
+    )
+    response.raise_for_status()
+
+
+PROBES = {
+    "postgres": probe_postgres,
+    "ldap": probe_ldap,
+    "freeipa": probe_freeipa,
+    "keycloak": probe_keycloak,
+}
+
+
+def _timed_probe(probe):
+    """
+    Run a probe and return (error or None, detail, latency in ms).
+    """
+    started = time.perf_counter()
+    try:
+        detail = probe()
+        error = None
+    except Exception as e:  # pylint: disable=broad-except
+        detail, error = None, type(e).__name__
+    return error, detail, round((time.perf_counter() - started) * 1000, 1)
+
+
+class ReadinessCheck:
+    """
+    Runs every probe concurrently and caches the combined result for ttl
+    seconds, so however often /ready is polled each worker sends at most one
+    round of probes per ttl. A probe still running from an earlier round is
+    waited on again rather than started a second time.
+
+    Keyword arguments:
+    probes -- Dict of dependency name to a callable that raises when it is down
+    timeout -- Seconds to wait for the probes before reporting a timeout
+    ttl -- Seconds a result is reused for
+    """
+
+    def __init__(self, probes, *, timeout=2, ttl=5):
+        self.probes = probes
+        self.timeout = timeout
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(probes), thread_name_prefix="ready"
+        )
+        self._running = {}
+        self._result = None
+        self._checked = 0
+
+    def _run(self):
+        """
+        Probe every dependency and report each one's status and latency.
+        """
+        started = time.perf_counter()
+        for name, probe in self.probes.items():
+            if name not in self._running or self._running[name].done():
+                self._running[name] = self._executor.submit(_timed_probe, probe)
+        wait(self._running.values(), timeout=self.timeout)
+
+        checks = {}
+        for name, future in self._running.items():
+            if not future.done():
+                checks[name] = {
+                    "status": "timeout",
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+                }
+                continue
+            error, detail, latency = future.result()
+            checks[name] = {"status": "fail" if error else "ok", "latency_ms": latency}
+            if error:
+                checks[name]["error"] = error
+            elif detail:
+                checks[name]["host"] = detail
+        return checks
+
+    def check(self):
+        """
+        Return the cached result if it is fresh, probing again otherwise.
+        Callers arriving during a round wait for it instead of starting
+        another.
+        """
+        with self._lock:
+            if self._result is None or time.monotonic() - self._checked >= self.ttl:
+                self._result = self._run()
+                self._checked = time.monotonic()
+            return self._result
+
+
+readiness = ReadinessCheck(
+    PROBES,
+    timeout=app.config["READY_PROBE_TIMEOUT"],
+    ttl=app.config["READY_CACHE_TTL"],
+)
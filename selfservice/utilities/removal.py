@@ -0,0 +1,137 @@
+"""
+Removes two-factor from every backend that holds part of it, all at once.
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from selfservice.utilities.app_passwd import delete_app_passwd
+from selfservice.utilities.keycloak import OTPNotConfigured, delete_kc_otp
+from selfservice.utilities.ldap import delete_ipa_otp
+from selfservice import app
+
+STEPS = {
+    "keycloak": delete_kc_otp,
+    "freeipa": delete_ipa_otp,
+    "app_passwd": delete_app_passwd,
+}
+
+# One pool per backend, shared by every request in the worker. A burst of
+# removals queues here instead of opening an unbounded number of backend
+# connections, and a hung backend only ties up its own pool's threads.
+executors = {}
+executors_lock = threading.Lock()
+
+
+def _executor(name):
+    """
+    The thread pool running removal steps for one backend.
+
+    Keyword arguments:
+    name -- Backend name, a key of STEPS
+    """
+    with executors_lock:
+        if name not in executors:
+            executors[name] = ThreadPoolExecutor(
+                max_workers=app.config["OTP_REMOVE_WORKERS"],
+                thread_name_prefix=f"otp-remove-{name}",
+            )
+        return executors[name]
+
+
+def _run_step(name, step, username, started):
+    """
+    Run one removal step in its own app context and return
+    (status, error or None, latency in ms).
+
+    Keyword arguments:
+    name -- Backend name
+    step -- Removal function
+    username -- User whose two-factor is being removed
+    started -- Dict the step's start time is recorded in, by name
+    """
+    started[name] = time.perf_counter()
+    with app.app_context():
+        try:
+            step(username)
+            status, error = "removed", None
+        except OTPNotConfigured:
+            status, error = "not_configured", None
+        except Exception as e:  # pylint: disable=broad-except
+            app.logger.exception("Removing two-factor for %s failed", username)
+            status, error = "failed", type(e).__name__
+    return status, error, round((time.perf_counter() - started[name]) * 1000, 1)
+
+
+def remove_two_factor(username, steps=None, timeout=None):
+    """
+    Run every removal step concurrently and report how each one went.
+
+    Each step has its own deadline, timeout seconds after it started running.
+    A step still waiting for a thread of its backend's pool after timeout
+    seconds, because earlier removals against that backend are stuck, is
+    cancelled and reported as skipped. One still running at its deadline is
+    reported as timed out and left to finish in the background. Backends do
+    not share threads, so a slow one never causes another to be skipped. The
+    call returns within twice the timeout.
+
+    Keyword arguments:
+    username -- User whose two-factor is being removed
+    steps -- Dict of backend name to removal function, defaults to STEPS
+    timeout -- Seconds each step may run, defaults to OTP_REMOVE_TIMEOUT
+    """
+    steps = steps or STEPS
+    timeout = timeout or app.config["OTP_REMOVE_TIMEOUT"]
+    submitted = time.perf_counter()
+    started = {}
+    futures = {
+        name: _executor(name).submit(_run_step, name, step, username, started)
+        for name, step in steps.items()
+    }
+
+    results = {}
+    pending = dict(futures)
+    while pending:
+        now = time.perf_counter()
+        for name, future in list(pending.items()):
+            if future.done():
+                status, error, latency = pending.pop(name).result()
+                results[name] = {"status": status, "latency_ms": latency}
+                if error:
+                    results[name]["error"] = error
+            elif now >= started.get(name, submitted) + timeout:
+                if future.cancel():
+                    del pending[name]
+                    results[name] = {"status": "skipped"}
+                elif name not in started:
+                    # It got a thread just now and gets its own full timeout
+                    started[name] = now
+                elif not future.done():
+                    del pending[name]
+                    results[name] = {
+                        "status": "timeout",
+                        "latency_ms": round((now - started[name]) * 1000, 1),
+                    }
+        if pending:
+            deadline = min(started.get(name, submitted) for name in pending) + timeout
+            wait(
+                pending.values(),
+                timeout=max(deadline - time.perf_counter(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+    return {name: results[name] for name in futures}
+
+
+def incomplete(results):
+    """
+    Names of the backends two-factor may still be configured on.
+
+    Keyword arguments:
+    results -- Result of remove_two_factor
+    """
+    return [
+        name
+        for name, result in results.items()
+        if result["status"] not in ("removed", "not_configured")
+    ]
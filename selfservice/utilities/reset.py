@@ -4,22 +4,16 @@ Functions relating to the verification of users and subsequent account resets.
 
 import random
 import uuid
-import requests
 import ldap
-import srvlookup
-
-from selfservice.models import ResetToken, PhoneVerification
-from selfservice.utilities.general import is_expired
-from selfservice import db, app
-
+import requests
 
-class TokenAlreadyExists(Exception):
-    """
-    Error generated when user had already used their session to generate
-    a reset token.
-    """
+from selfservice.utilities import http
+from selfservice.utilities.metrics import timed
+from selfservice.utilities.state import store
+from selfservice import ipa_servers, ipa_ldap
 
-    pass
+# Errors that mean a FreeIPA server is unreachable and another should be tried.
+IPA_HOST_ERRORS = (ldap.SERVER_DOWN, requests.ConnectionError)
 
 
 class PasswordChangeFailed(Exception):
@@ -52,22 +46,13 @@ def generate_token(session):
     Create a password reset token.
 
     Keyword arguments:
-    session -- Instance of RecoverySession model
+    session -- RecoveryState of the session
     """
     # Generate a random UUID for reset token.
     token = str(uuid.uuid4())
 
-    # Verify that this session creates only one token.
-    previous = ResetToken.query.filter_by(session=session.id).first()
-    if previous:
-        raise TokenAlreadyExists()
-
-        # Create the object in the database.
-    reset = ResetToken(
-        username=session.username, token=token, session=session.id, used=False
-    )
-    db.session.add(reset)
-    db.session.commit()
+    # The store makes sure that this session creates only one token.
+    store.add_token(session, token)
 
     return token
 
@@ -77,23 +62,28 @@ def generate_pin(session):
     Generate a six-digit pin for SMS verification.
 
     Keyword arguments:
-    session -- Instance of RecoverySession model
+    session -- RecoveryState of the session
     """
 
-    # Generate a random UUID for reset token.
-    token = f"{random.randrange(1, 10**6):06}"
+    # Generate a random six-digit PIN, picking again if another session
+    # holds the same one. The store refuses a PIN once the session created a
+    # reset token.
+    while True:
+        token = f"{random.randrange(1, 10**6):06}"
+        if store.add_pin(session, token):
+            return token
 
-    # Verify that this session creates only one token.
-    previous = ResetToken.query.filter_by(session=session.id).first()
-    if previous:
-        raise TokenAlreadyExists()
 
-        # Create the object in the database.
-    reset = PhoneVerification(code=token, session=session.id)
-    db.session.add(reset)
-    db.session.commit()
+def redeem_pin(session_id, pin):
+    """
+    Check an SMS verification PIN and return the reset token it unlocks, or
+    None if it did not match.
 
-    return token
+    Keyword arguments:
+    session_id -- ID of the recovery session
+    pin -- PIN entered by the user
+    """
+    return store.redeem_pin(session_id, pin, str(uuid.uuid4()))
 
 
 def valid_token(token_id):
@@ -101,16 +91,10 @@ def valid_token(token_id):
     Ensure that the token provided is still valid.
 
     Keyword arguments:
-    token_id -- ID of a ResetToken object
+    token_id -- Reset token
     """
 
-    token_data = ResetToken.query.filter_by(token=token_id).first()
-
-    if token_data:
-        if is_expired(token_data.created, 30):
-            return False
-        return True
-    return False
+    return store.get_token(token_id) is not None
 
 
 def passwd_reset(username, password):
@@ -123,24 +107,33 @@ def passwd_reset(username, password):
     password -- Desired password for the user
     """
 
-    # Create LDAP admin session to perform initial reset.
     dn = f"uid={username},cn=users,cn=accounts,dc=csh,dc=rit,dc=edu"
 
-    # Find FreeIPA server
-    ldap_srvs = srvlookup.lookup("ldap", "tcp", "csh.rit.edu")
-    ldap_uri = ldap_srvs[0].hostname
-    l = ldap.initialize(f"ldaps://{ldap_uri}")
-    l.simple_bind_s(app.config["LDAP_BIND_DN"], app.config["LDAP_BIND_PW"])
-    l.modify_s(dn, [(ldap.MOD_REPLACE, "userPassword", [password.encode()])])
-    l.modify_s(dn, [(ldap.MOD_REPLACE, "nsaccountlock", ["false".encode()])])
-
-    # FreeIPA automatically expires the password set through the previous
-    # method, so we need to use their password change API to get past that.
-    requests.post(
-        f"https://{ldap_uri}/ipa/session/change_password",
-        data={"user": username, "old_password": password, "new_password": password},
-        timeout=30,
-    )
+    def reset(conn, ldap_uri):
+        # Use a pooled LDAP admin session to perform initial reset.
+        with timed("freeipa_ldap", "reset_password"):
+            conn.modify_s(
+                dn,
+                [
+                    (ldap.MOD_REPLACE, "userPassword", [password.encode()]),
+                    (ldap.MOD_REPLACE, "nsaccountlock", ["false".encode()]),
+                ],
+            )
+
+        # FreeIPA automatically expires the password set through the previous
+        # method, so we need to use their password change API to get past that.
+        # This must hit the same server so it sees the new password.
+        with timed("freeipa", "change_password"):
+            http.post(
+                f"https://{ldap_uri}/ipa/session/change_password",
+                data={
+                    "user": username,
+                    "old_password": password,
+                    "new_password": password,
+                },
+            )
+
+    ipa_ldap.run(reset, IPA_HOST_ERRORS)
 
 
 def passwd_change(username, old_pw, new_pw):
@@ -152,21 +145,22 @@ def passwd_change(username, old_pw, new_pw):
     old_pw -- Current password for the account
     new_pw -- Desired new password.
     """
-    # Find FreeIPA server
-    ldap_srvs = srvlookup.lookup("ldap", "tcp", "csh.rit.edu")
-    ldap_uri = ldap_srvs[0].hostname
-    password_url = f"https://{ldap_uri}/ipa/session/change_password"
-    headers = {
-        "Referer": password_url,
-        "Content-Type": "application/x-www-form-urlencoded",
-        "Accept": "text/plain",
-    }
-    change = requests.post(
-        password_url,
-        headers=headers,
-        data={"user": username, "old_password": old_pw, "new_password": new_pw},
-        timeout=30,
-    )
+
+    def change(ldap_uri):
+        password_url = f"https://{ldap_uri}/ipa/session/change_password"
+        headers = {
+            "Referer": password_url,
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "text/plain",
+        }
+        with timed("freeipa", "change_password"):
+            return http.post(
+                password_url,
+                headers=headers,
+                data={"user": username, "old_password": old_pw, "new_password": new_pw},
+            )
+
+    change = ipa_servers.failover(change, IPA_HOST_ERRORS)
     pwchange_result = change.headers.get("X-IPA-Pwchange-Result")
     if pwchange_result == "invalid-password":
         raise CurrentPasswordInvalid
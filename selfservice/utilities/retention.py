@@ -0,0 +1,178 @@
+"""
+Pruning of expired recovery sessions, reset tokens, PIN codes, delivered
+messages and Keycloak user ID evictions.
+
+Rows are only checked for expiry when they are read, so without pruning the
+tables grow forever. Deletes run in small batches, each in its own
+transaction, so no lock is held for long.
+
+Rows pruned and time taken are exported as Prometheus counters. Run the
+command with the server's PROMETHEUS_MULTIPROC_DIR for /metrics to include
+them.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from selfservice.utilities.metrics import PRUNE_DURATION, PRUNE_LAST_RUN, PRUNED_ROWS
+from selfservice.models import (
+    KeycloakUserEviction,
+    OutboundMessage,
+    PhoneVerification,
+    RecoverySession,
+    ResetToken,
+)
+from selfservice import app, db
+
+
+def _cutoff(setting):
+    """
+    Oldest creation time kept by the retention window named setting.
+    """
+    return datetime.utcnow() - timedelta(minutes=app.config[setting])
+
+
+def _delete_batches(table, ids, batch_size, pause):
+    """
+    Repeatedly delete up to batch_size rows of table whose primary key is in
+    the ids subquery, committing after each batch. Returns the row count.
+
+    Keyword arguments:
+    table -- Table to delete from
+    ids -- Select of primary keys eligible for deletion
+    batch_size -- Rows deleted per transaction
+    pause -- Seconds to sleep between batches
+    """
+    column = list(table.primary_key)[0]
+    total = 0
+    while True:
+        deleted = db.session.execute(
+            table.delete().where(column.in_(ids.limit(batch_size)))
+        ).rowcount
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def _delete_sessions(cutoff, batch_size, pause):
+    """
+    Delete sessions created before cutoff together with every row that
+    references them. Returns counts per table.
+    """
+    counts = {"phone_codes": 0, "token": 0, "outbound_message": 0, "session": 0}
+    while True:
+        ids = (
+            db.session.execute(
+                select(RecoverySession.id)
+                .where(RecoverySession.created < cutoff)
+                .limit(batch_size)
+            )
+            .scalars()
+            .all()
+        )
+        if not ids:
+            return counts
+        for model in (PhoneVerification, ResetToken, OutboundMessage):
+            counts[model.__tablename__] += db.session.execute(
+                model.__table__.delete().where(model.session.in_(ids))
+            ).rowcount
+        counts["session"] += db.session.execute(
+            RecoverySession.__table__.delete().where(RecoverySession.id.in_(ids))
+        ).rowcount
+        db.session.commit()
+        if len(ids) < batch_size:
+            return counts
+        time.sleep(pause)
+
+
+def prune(batch_size=None, pause=None):
+    """
+    Delete everything past its retention window. Returns a dict of table
+    name to (rows deleted, seconds taken).
+
+    Keyword arguments:
+    batch_size -- Rows deleted per transaction
+    pause -- Seconds to sleep between batches
+    """
+    batch_size = batch_size or app.config["PRUNE_BATCH_SIZE"]
+    pause = app.config["PRUNE_BATCH_PAUSE"] if pause is None else pause
+    results = {}
+
+    started = time.monotonic()
+    rows = _delete_batches(
+        PhoneVerification.__table__,
+        select(PhoneVerification.code)
+        .join(RecoverySession, PhoneVerification.session == RecoverySession.id)
+        .where(RecoverySession.created < _cutoff("PHONE_CODE_RETENTION")),
+        batch_size,
+        pause,
+    )
+    results["phone_codes"] = (rows, time.monotonic() - started)
+
+    started = time.monotonic()
+    rows = _delete_batches(
+        ResetToken.__table__,
+        select(ResetToken.id).where(ResetToken.created < _cutoff("TOKEN_RETENTION")),
+        batch_size,
+        pause,
+    )
+    results["token"] = (rows, time.monotonic() - started)
+
+    started = time.monotonic()
+    rows = _delete_batches(
+        OutboundMessage.__table__,
+        select(OutboundMessage.id).where(
+            OutboundMessage.status.in_(["sent", "failed"]),
+            OutboundMessage.created < _cutoff("MESSAGE_RETENTION"),
+        ),
+        batch_size,
+        pause,
+    )
+    results["outbound_message"] = (rows, time.monotonic() - started)
+
+    # Every worker's cached ID has expired by the time an eviction is this old.
+    started = time.monotonic()
+    rows = _delete_batches(
+        KeycloakUserEviction.__table__,
+        select(KeycloakUserEviction.username).where(
+            KeycloakUserEviction.evicted
+            < datetime.utcnow() - timedelta(seconds=app.config["KC_USER_CACHE_TTL"])
+        ),
+        batch_size,
+        pause,
+    )
+    results["kc_user_evictions"] = (rows, time.monotonic() - started)
+
+    # Children still attached to an expired session are removed with it;
+    # their rows count towards their own tables and the time towards session.
+    started = time.monotonic()
+    counts = _delete_sessions(_cutoff("SESSION_RETENTION"), batch_size, pause)
+    results["session"] = (counts.pop("session"), time.monotonic() - started)
+    for table, rows in counts.items():
+        previous, seconds = results[table]
+        results[table] = (previous + rows, seconds)
+
+    for table, (rows, seconds) in results.items():
+        PRUNED_ROWS.labels(table).inc(rows)
+        PRUNE_DURATION.labels(table).inc(seconds)
+    PRUNE_LAST_RUN.set_to_current_time()
+    return results
+
+
+@click.command("prune")
+@click.option("--batch-size", type=int, help="Rows deleted per transaction.")
+@click.option("--pause", type=float, help="Seconds to sleep between batches.")
+@with_appcontext
+def prune_command(batch_size, pause):
+    """
+    Delete expired recovery sessions, tokens, PIN codes, delivered messages
+    and Keycloak user ID evictions.
+    """
+    for table, (rows, seconds) in prune(batch_size, pause).items():
+        click.echo(f"{table}: {rows} rows pruned in {seconds:.2f}s")
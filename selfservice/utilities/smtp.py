@@ -0,0 +1,234 @@
+"""
+Thread-safe pool of reusable SMTP connections.
+"""
+
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+LOG = logging.getLogger(__name__)
+
+
+def make_message(sender, recipient, subject, body):
+    """
+    Build a plain text email.
+
+    Keyword arguments:
+    sender -- From header
+    recipient -- To header
+    subject -- Subject header
+    body -- Message text
+    """
+    email = MIMEText(body)
+    email["To"] = recipient
+    email["From"] = sender
+    email["Subject"] = subject
+    email["Date"] = formatdate()
+    return email
+
+
+class _PooledSMTP:
+    """
+    An open SMTP session and how much it has been used.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """
+    Keeps up to size SMTP sessions open so messages skip the connect, EHLO,
+    STARTTLS and AUTH steps. Sessions idle for longer than idle_check are
+    probed with NOOP before reuse and are retired after max_messages.
+
+    Keyword arguments:
+    host -- SMTP server to relay through
+    port -- Port of the SMTP server
+    size -- Maximum number of open sessions
+    timeout -- Socket timeout in seconds
+    starttls -- Upgrade sessions with STARTTLS
+    username -- Optional AUTH username
+    password -- Optional AUTH password
+    max_messages -- Messages sent on a session before it is replaced
+    idle_check -- Seconds of idleness after which a session is probed
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        host,
+        port=25,
+        *,
+        size=2,
+        timeout=30,
+        starttls=False,
+        username=None,
+        password=None,
+        max_messages=100,
+        idle_check=30,
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.starttls = starttls
+        self.max_messages = max_messages
+        self.idle_check = idle_check
+        self._credentials = (username, password)
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        """
+        Open, secure and authenticate a new session.
+        """
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls(context=ssl.create_default_context())
+            server.ehlo()
+        username, password = self._credentials
+        if username:
+            server.login(username, password)
+        return _PooledSMTP(server)
+
+    @staticmethod
+    def _discard(entry):
+        """
+        Close a session that is leaving the pool.
+        """
+        try:
+            entry.server.quit()
+        except (smtplib.SMTPException, OSError):
+            entry.server.close()
+
+    def _checkout(self):
+        """
+        Take a live idle session, or open a new one.
+        """
+        # Sockets opened before a fork belong to the parent process.
+        if self._pid != os.getpid():
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+
+            if time.monotonic() - entry.last_used < self.idle_check:
+                return entry
+            try:
+                if entry.server.noop()[0] == 250:
+                    return entry
+            except (smtplib.SMTPException, OSError):
+                pass
+            LOG.info("Replacing dead SMTP connection to %s", self.host)
+            self._discard(entry)
+
+    def _release(self, entry):
+        """
+        Return a session to the pool, or retire it once it is worn out.
+        """
+        entry.last_used = time.monotonic()
+        if entry.sent >= self.max_messages:
+            self._discard(entry)
+        else:
+            self._idle.put(entry)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a session for the duration of a with block.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise smtplib.SMTPException("No SMTP connection became available")
+        try:
+            entry = self._checkout()
+            try:
+                yield entry
+            except smtplib.SMTPServerDisconnected:
+                self._discard(entry)
+                raise
+            except smtplib.SMTPException:
+                # The server answered, so the session is still usable.
+                self._release(entry)
+                raise
+            except Exception:
+                # A socket error (OSError) or anything unexpected leaves the
+                # session in an unknown state.
+                self._discard(entry)
+                raise
+            self._release(entry)
+        finally:
+            self._slots.release()
+
+    def send(self, message):
+        """
+        Send one message, retrying once on a fresh session if the pooled one
+        was dropped by the server.
+
+        Keyword arguments:
+        message -- email.message.Message to send
+        """
+        for attempt in range(2):
+            try:
+                with self.connection() as entry:
+                    entry.server.send_message(message)
+                    entry.sent += 1
+                    return
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+
+    def send_many(self, messages):
+        """
+        Send a batch of messages, such as a notification to every RTP, reusing
+        each session for up to max_messages of them. Returns a list of
+        (message, error) for the messages that failed.
+
+        Keyword arguments:
+        messages -- Iterable of email.message.Message
+        """
+        failed = []
+        pending = list(messages)
+        while pending:
+            try:
+                with self.connection() as entry:
+                    while pending and entry.sent < self.max_messages:
+                        try:
+                            entry.server.send_message(pending[0])
+                            entry.sent += 1
+                        except (
+                            smtplib.SMTPRecipientsRefused,
+                            smtplib.SMTPDataError,
+                        ) as e:
+                            failed.append((pending[0], e))
+                        pending.pop(0)
+            except (smtplib.SMTPException, OSError) as e:
+                # The session died mid-batch; the message in flight fails and
+                # the rest continue on a new session.
+                failed.append((pending.pop(0), e))
+        return failed
+
+    def close(self):
+        """
+        Close every idle session.
+        """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
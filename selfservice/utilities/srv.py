@@ -0,0 +1,149 @@
+"""
+Cached DNS SRV resolution with RFC 2782 ordering and host failover.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from dns import exception, resolver
+
+LOG = logging.getLogger(__name__)
+
+
+def order_records(records):
+    """
+    Order SRV records as described in RFC 2782: ascending priority, and a
+    weighted random shuffle among records sharing a priority.
+
+    Keyword arguments:
+    records -- List of (priority, weight, hostname, port) tuples
+    """
+    ordered = []
+    for priority in sorted({record[0] for record in records}):
+        # Zero-weight records go first so they keep a small chance of being
+        # picked ahead of weighted ones.
+        group = sorted(
+            (record for record in records if record[0] == priority),
+            key=lambda record: record[1],
+        )
+        while group:
+            total = sum(record[1] for record in group)
+            pick = random.uniform(0, total)
+            running = 0
+            for index, record in enumerate(group):
+                running += record[1]
+                if running >= pick:
+                    ordered.append(group.pop(index))
+                    break
+    return ordered
+
+
+class SRVResolver:
+    """
+    Resolves an SRV record, caches the answer for its TTL and hands out
+    healthy targets in RFC 2782 order. Hosts reported as failing are skipped
+    until their cooldown runs out.
+
+    Keyword arguments:
+    name -- Service name, e.g. "ldap"
+    protocol -- Protocol name, e.g. "tcp"
+    domain -- Domain holding the record
+    cooldown -- Seconds a failing host is skipped for
+    min_ttl -- Lower bound on how long an answer is cached
+    """
+
+    def __init__(self, name, protocol, domain, *, cooldown=30, min_ttl=30):
+        self.fqdn = f"_{name}._{protocol}.{domain}"
+        self.cooldown = cooldown
+        self.min_ttl = min_ttl
+        self._lock = threading.Lock()
+        self._records = []
+        self._expires = 0
+        self._unhealthy = {}
+
+    def _refresh(self):
+        """
+        Re-resolve the record if the cached answer has expired. A stale answer
+        is kept if the lookup fails.
+        """
+        now = time.monotonic()
+        if self._records and now < self._expires:
+            return
+
+        try:
+            answer = resolver.resolve(self.fqdn, "SRV")
+        except exception.DNSException:
+            if not self._records:
+                raise
+            LOG.warning("SRV lookup for %s failed, using stale answer", self.fqdn)
+            self._expires = now + self.min_ttl
+            return
+
+        self._records = [
+            (rr.priority, rr.weight, rr.target.to_text().rstrip("."), rr.port)
+            for rr in answer
+        ]
+        self._expires = now + max(answer.rrset.ttl, self.min_ttl)
+
+    def hosts(self):
+        """
+        Return every target hostname, healthy ones first, in RFC 2782 order.
+        """
+        with self._lock:
+            self._refresh()
+            records = list(self._records)
+            now = time.monotonic()
+            unhealthy = {host for host, until in self._unhealthy.items() if until > now}
+
+        ordered = [record[2] for record in order_records(records)]
+        return [host for host in ordered if host not in unhealthy] + [
+            host for host in ordered if host in unhealthy
+        ]
+
+    def get_host(self):
+        """
+        Return the next target to use.
+        """
+        return self.hosts()[0]
+
+    def is_unhealthy(self, host):
+        """
+        Whether host is still in its cooldown after failing.
+
+        Keyword arguments:
+        host -- Hostname to check
+        """
+        with self._lock:
+            return self._unhealthy.get(host, 0) > time.monotonic()
+
+    def mark_unhealthy(self, host):
+        """
+        Skip host for the configured cooldown.
+
+        Keyword arguments:
+        host -- Hostname that failed
+        """
+        LOG.warning("Marking %s unhealthy for %ss", host, self.cooldown)
+        with self._lock:
+            self._unhealthy[host] = time.monotonic() + self.cooldown
+
+    def failover(self, func, errors):
+        """
+        Call func with each target in turn until one succeeds. Hosts raising
+        one of errors are marked unhealthy; the last error is re-raised if
+        every host fails.
+
+        Keyword arguments:
+        func -- Callable taking a hostname
+        errors -- Exception types that indicate the host is unreachable
+        """
+        hosts = self.hosts()
+        for host in hosts:
+            try:
+                return func(host)
+            except errors:
+                self.mark_unhealthy(host)
+                if host == hosts[-1]:
+                    raise
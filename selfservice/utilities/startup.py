@@ -0,0 +1,58 @@
+"""
+Background warm-up of the clients that connect on first use.
+"""
+
+import logging
+import threading
+import time
+
+from selfservice.utilities.metrics import STARTUP_DURATION
+from selfservice import app, db, auth, ldap, ipa, ipa_servers
+
+LOG = logging.getLogger(__name__)
+
+
+def _connect_db():
+    """
+    Open the first pooled database connection.
+    """
+    with app.app_context():
+        with db.engine.connect():
+            pass
+
+
+def warm_up():
+    """
+    Resolve FreeIPA servers and build every lazy client, so the first
+    requests a worker serves do not pay for it. A step that fails is logged
+    and retried on first use as usual.
+    """
+    steps = {
+        "srv": ipa_servers.hosts,
+        "ldap": ldap.get,
+        "freeipa": ipa.get,
+        "oidc": auth.clients.get,
+        "postgres": _connect_db,
+    }
+    started = time.perf_counter()
+    for name, step in steps.items():
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception:  # pylint: disable=broad-exception-caught
+            LOG.warning("Warm-up of %s failed", name, exc_info=True)
+            continue
+        LOG.debug("Warmed up %s in %.3fs", name, time.perf_counter() - step_started)
+
+    seconds = time.perf_counter() - started
+    STARTUP_DURATION.labels("warm_up").set(seconds)
+    LOG.info("Warm-up finished in %.3fs", seconds)
+
+
+def start_warm_up():
+    """
+    Run warm_up in a background thread if enabled. Meant to be called once
+    per worker, after it has forked.
+    """
+    if app.config["WARM_UP"]:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
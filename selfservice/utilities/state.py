@@ -0,0 +1,729 @@
+"""
+Storage for short-lived account recovery state: recovery sessions, reset
+tokens and phone verification PINs.
+
+RECOVERY_STATE_BACKEND picks where it lives. "sql" keeps it in Postgres
+through the SQLAlchemy models. "redis" and "memory" keep it in a key-value
+store where expiry is native, so no pruning is needed and each step costs
+a single round trip.
+"""
+
+import hmac
+import json
+import re
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import redis
+from sqlalchemy import delete, exists, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from selfservice.models import RecoverySession, ResetToken, PhoneVerification
+from selfservice.utilities.general import is_expired
+from selfservice.utilities.metrics import timed
+from selfservice import app, db
+
+RecoveryState = namedtuple("RecoveryState", ["id", "username", "created", "methods"])
+TokenState = namedtuple(
+    "TokenState", ["token", "username", "session", "created", "used"]
+)
+
+
+class TokenAlreadyExists(Exception):
+    """
+    Error generated when user had already used their session to generate
+    a reset token.
+    """
+
+    pass
+
+
+PIN_FORMAT = re.compile(r"[0-9]{6}")
+
+
+def _pin_matches(stored, pin):
+    """
+    Compare a PIN in constant time. Input that is not six ASCII digits never
+    matches, and is never handed to compare_digest, which only takes ASCII.
+
+    Keyword arguments:
+    stored -- PIN that was sent
+    pin -- PIN entered by the user
+    """
+    if not isinstance(pin, str) or not PIN_FORMAT.fullmatch(pin):
+        return False
+    return hmac.compare_digest(stored, pin)
+
+
+class RecoveryStateStore(ABC):
+    """
+    Interface shared by every recovery state backend. A backend missing any
+    of these methods cannot be instantiated.
+
+    Keyword arguments:
+    session_ttl -- Seconds a recovery session, and its PIN, stays valid
+    token_ttl -- Seconds a reset token stays valid
+    """
+
+    def __init__(self, session_ttl=600, token_ttl=1800):
+        self.session_ttl = session_ttl
+        self.token_ttl = token_ttl
+
+    @abstractmethod
+    def create_session(self, username, methods=None):
+        """
+        Start a recovery session and return its RecoveryState.
+
+        Keyword arguments:
+        username -- Account being recovered
+        methods -- Verification methods found for the account
+        """
+
+    @abstractmethod
+    def get_session(self, session_id):
+        """
+        Return the RecoveryState of a live session, or None.
+
+        Keyword arguments:
+        session_id -- ID of the recovery session
+        """
+
+    @abstractmethod
+    def save_methods(self, session_id, methods):
+        """
+        Store the verification methods of a session.
+
+        Keyword arguments:
+        session_id -- ID of the recovery session
+        methods -- Verification methods found for the account
+        """
+
+    @abstractmethod
+    def add_token(self, session, token):
+        """
+        Store the reset token of a session. Raises TokenAlreadyExists if the
+        session already has one.
+
+        Keyword arguments:
+        session -- RecoveryState the token belongs to
+        token -- Reset token to store
+        """
+
+    @abstractmethod
+    def session_token(self, session_id):
+        """
+        Return the reset token created by a session, or None.
+
+        Keyword arguments:
+        session_id -- ID of the recovery session
+        """
+
+    @abstractmethod
+    def get_token(self, token):
+        """
+        Return the TokenState of a live, unused reset token, or None.
+
+        Keyword arguments:
+        token -- Reset token
+        """
+
+    @abstractmethod
+    def claim_token(self, token):
+        """
+        Atomically mark a live reset token as used and return its
+        TokenState. Returns None if it was expired or already used, so only
+        one caller can ever claim a token.
+
+        Keyword arguments:
+        token -- Reset token
+        """
+
+    @abstractmethod
+    def release_token(self, token):
+        """
+        Make a claimed token usable again, for when the reset failed.
+
+        Keyword arguments:
+        token -- TokenState returned by claim_token
+        """
+
+    @abstractmethod
+    def add_pin(self, session, pin):
+        """
+        Store the phone verification PIN of a session, replacing any earlier
+        one. Returns False if the PIN is already in use by another session
+        and a new one should be picked. Raises TokenAlreadyExists if the
+        session already has a reset token.
+
+        Keyword arguments:
+        session -- RecoveryState the PIN belongs to
+        pin -- PIN sent to the user
+        """
+
+    @abstractmethod
+    def redeem_pin(self, session_id, pin, token):
+        """
+        Consume the PIN of a session and, if it matched pin, return the
+        session's reset token, storing token as it if there is none yet.
+        Returns None on a wrong PIN or dead session. Any attempt, right or
+        wrong, uses the PIN up.
+
+        Keyword arguments:
+        session_id -- ID of the recovery session
+        pin -- PIN entered by the user
+        token -- Reset token to store if the session has none
+        """
+
+    @abstractmethod
+    def recent_sessions(self, limit=20):
+        """
+        List the newest sessions for the admin page, as dicts with the
+        username, session_created, session_expired, token_created and used
+        keys.
+
+        Keyword arguments:
+        limit -- Maximum number of sessions
+        """
+
+
+class SQLStateStore(RecoveryStateStore):
+    """
+    Keeps recovery state in the session, token and phone_codes tables.
+    """
+
+    def _cutoff(self, ttl):
+        """
+        Oldest creation time that is still valid for ttl.
+        """
+        return datetime.utcnow() - timedelta(seconds=ttl)
+
+    @staticmethod
+    def _session_state(row):
+        """
+        Convert a RecoverySession row.
+        """
+        return RecoveryState(row.id, row.username, row.created, row.methods)
+
+    @staticmethod
+    def _token_state(row):
+        """
+        Convert a ResetToken row.
+        """
+        return TokenState(row.token, row.username, row.session, row.created, row.used)
+
+    def create_session(self, username, methods=None):
+        session_id = str(uuid.uuid4())
+        created = db.session.execute(
+            insert(RecoverySession)
+            .values(id=session_id, username=username, methods=methods)
+            .returning(RecoverySession.created)
+        ).scalar_one()
+        db.session.commit()
+        return RecoveryState(session_id, username, created, methods)
+
+    def get_session(self, session_id):
+        row = RecoverySession.query.filter(
+            RecoverySession.id == session_id,
+            RecoverySession.created >= self._cutoff(self.session_ttl),
+        ).first()
+        return self._session_state(row) if row else None
+
+    def save_methods(self, session_id, methods):
+        RecoverySession.query.filter_by(id=session_id).update({"methods": methods})
+        db.session.commit()
+
+    @staticmethod
+    def _insert_token(session_id, username, token):
+        """
+        Insert a reset token unless the session has one. Returns the token,
+        or None if the uq_token_session constraint refused it.
+        """
+        return db.session.execute(
+            insert(ResetToken)
+            .values(username=username, token=token, session=session_id, used=False)
+            .on_conflict_do_nothing(constraint="uq_token_session")
+            .returning(ResetToken.token)
+        ).scalar()
+
+    def add_token(self, session, token):
+        created = self._insert_token(session.id, session.username, token)
+        db.session.commit()
+        if created is None:
+            raise TokenAlreadyExists()
+
+    def session_token(self, session_id):
+        row = ResetToken.query.filter_by(session=session_id).first()
+        return row.token if row else None
+
+    def get_token(self, token):
+        row = ResetToken.query.filter(
+            ResetToken.token == token,
+            ResetToken.used.is_(False),
+            ResetToken.created >= self._cutoff(self.token_ttl),
+        ).first()
+        return self._token_state(row) if row else None
+
+    def claim_token(self, token):
+        # Only one UPDATE can flip used, so only one caller gets a row back.
+        row = db.session.execute(
+            update(ResetToken)
+            .where(
+                ResetToken.token == token,
+                ResetToken.used.is_(False),
+                ResetToken.created >= self._cutoff(self.token_ttl),
+            )
+            .values(used=True)
+            .returning(
+                ResetToken.token,
+                ResetToken.username,
+                ResetToken.session,
+                ResetToken.created,
+                ResetToken.used,
+            )
+            .execution_options(synchronize_session=False)
+        ).first()
+        db.session.commit()
+        return self._token_state(row) if row else None
+
+    def release_token(self, token):
+        ResetToken.query.filter_by(token=token.token).update({"used": False})
+        db.session.commit()
+
+    def add_pin(self, session, pin):
+        PhoneVerification.query.filter_by(session=session.id).delete()
+        # Insert only while the session has no token, in the same statement.
+        created = db.session.execute(
+            insert(PhoneVerification)
+            .from_select(
+                ["code", "session"],
+                select(literal(pin), literal(session.id)).where(
+                    ~exists().where(ResetToken.session == session.id)
+                ),
+            )
+            .on_conflict_do_nothing()
+            .returning(PhoneVerification.code)
+        ).scalar()
+        db.session.commit()
+        if created is not None:
+            return True
+        if self.session_token(session.id):
+            raise TokenAlreadyExists()
+        return False
+
+    def redeem_pin(self, session_id, pin, token):
+        # Consume the PIN and read the live session it belongs to in one
+        # statement, then issue the token in the same transaction.
+        rows = db.session.execute(
+            delete(PhoneVerification)
+            .where(
+                PhoneVerification.session == RecoverySession.id,
+                RecoverySession.id == session_id,
+                RecoverySession.created >= self._cutoff(self.session_ttl),
+            )
+            .returning(PhoneVerification.code, RecoverySession.username)
+            .execution_options(synchronize_session=False)
+        ).all()
+        matched = [row for row in rows if _pin_matches(row.code, pin)]
+        if matched:
+            token = self._insert_token(
+                session_id, matched[0].username, token
+            ) or self.session_token(session_id)
+        else:
+            token = None
+        db.session.commit()
+        return token
+
+    def recent_sessions(self, limit=20):
+        session_minutes = self.session_ttl / 60
+        token_minutes = self.token_ttl / 60
+        return [
+            {
+                "username": s.username,
+                "session_created": s.session_created,
+                "session_expired": (
+                    (
+                        is_expired(s.session_created, session_minutes)
+                        and not s.token_created
+                    )
+                    or is_expired(s.token_created, token_minutes)
+                ),
+                "token_created": s.token_created,
+                "used": s.used,
+            }
+            for s in RecoverySession.query.outerjoin(
+                ResetToken, RecoverySession.id == ResetToken.session
+            )
+            .with_entities(
+                RecoverySession.username,
+                RecoverySession.created.label("session_created"),
+                ResetToken.created.label("token_created"),
+                ResetToken.used,
+            )
+            .order_by(RecoverySession.created.desc())
+            .limit(limit)
+            .all()
+        ]
+
+
+class KVStateStore(RecoveryStateStore):
+    """
+    Keeps recovery state in a Redis-compatible key-value store. Every key
+    carries its own expiry, and GETDEL makes tokens and PINs single use.
+
+    Keys, under prefix:
+    session:<id> -- JSON of the session, lives for session_ttl
+    pin:<id> -- PIN of the session, lives as long as the session
+    token:<token> -- JSON of the reset token, lives for token_ttl
+    session-token:<id> -- JSON of the session's token and whether it was
+        used; created with NX so a session gets only one token
+    recent -- Newest sessions, for the admin page
+
+    Keyword arguments:
+    client -- Redis client, or MemoryKV, returning str values
+    prefix -- Prefix for every key
+    recent_size -- Number of sessions kept for the admin page
+    """
+
+    def __init__(self, client, prefix="selfservice:", recent_size=100, **kwargs):
+        super().__init__(**kwargs)
+        self._kv = client
+        self._prefix = prefix
+        self._recent_size = recent_size
+
+    def _key(self, *parts):
+        """
+        Build a namespaced key.
+        """
+        return self._prefix + ":".join(parts)
+
+    @staticmethod
+    def _remaining(created, ttl):
+        """
+        Whole seconds left until something created at created outlives ttl.
+        """
+        return max(1, int(ttl - (datetime.utcnow() - created).total_seconds()))
+
+    def create_session(self, username, methods=None):
+        session = RecoveryState(str(uuid.uuid4()), username, datetime.utcnow(), methods)
+        self._kv.set(
+            self._key("session", session.id),
+            json.dumps(
+                {
+                    "username": username,
+                    "created": session.created.isoformat(),
+                    "methods": methods,
+                }
+            ),
+            ex=self.session_ttl,
+        )
+        self._kv.lpush(
+            self._key("recent"),
+            json.dumps(
+                {
+                    "id": session.id,
+                    "username": username,
+                    "created": session.created.isoformat(),
+                }
+            ),
+        )
+        self._kv.ltrim(self._key("recent"), 0, self._recent_size - 1)
+        return session
+
+    def get_session(self, session_id):
+        raw = self._kv.get(self._key("session", session_id))
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return RecoveryState(
+            session_id,
+            data["username"],
+            datetime.fromisoformat(data["created"]),
+            data["methods"],
+        )
+
+    def save_methods(self, session_id, methods):
+        session = self.get_session(session_id)
+        if session:
+            self._kv.set(
+                self._key("session", session_id),
+                json.dumps(
+                    {
+                        "username": session.username,
+                        "created": session.created.isoformat(),
+                        "methods": methods,
+                    }
+                ),
+                xx=True,
+                keepttl=True,
+            )
+
+    def add_token(self, session, token):
+        created = datetime.utcnow()
+        claimed = self._kv.set(
+            self._key("session-token", session.id),
+            json.dumps({"token": token, "created": created.isoformat(), "used": False}),
+            ex=self.token_ttl,
+            nx=True,
+        )
+        if not claimed:
+            raise TokenAlreadyExists()
+        self._kv.set(
+            self._key("token", token),
+            json.dumps(
+                {
+                    "username": session.username,
+                    "session": session.id,
+                    "created": created.isoformat(),
+                }
+            ),
+            ex=self.token_ttl,
+        )
+
+    def session_token(self, session_id):
+        raw = self._kv.get(self._key("session-token", session_id))
+        return json.loads(raw)["token"] if raw else None
+
+    @staticmethod
+    def _token_state(token, raw, used=False):
+        """
+        Decode a token record.
+        """
+        data = json.loads(raw)
+        return TokenState(
+            token,
+            data["username"],
+            data["session"],
+            datetime.fromisoformat(data["created"]),
+            used,
+        )
+
+    def _mark_used(self, token, used):
+        """
+        Record on the session whether its token was used, for the admin page.
+        """
+        self._kv.set(
+            self._key("session-token", token.session),
+            json.dumps(
+                {
+                    "token": token.token,
+                    "created": token.created.isoformat(),
+                    "used": used,
+                }
+            ),
+            xx=True,
+            keepttl=True,
+        )
+
+    def get_token(self, token):
+        raw = self._kv.get(self._key("token", token))
+        return self._token_state(token, raw) if raw else None
+
+    def claim_token(self, token):
+        raw = self._kv.getdel(self._key("token", token))
+        if raw is None:
+            return None
+        claimed = self._token_state(token, raw, used=True)
+        self._mark_used(claimed, True)
+        return claimed
+
+    def release_token(self, token):
+        self._kv.set(
+            self._key("token", token.token),
+            json.dumps(
+                {
+                    "username": token.username,
+                    "session": token.session,
+                    "created": token.created.isoformat(),
+                }
+            ),
+            ex=self._remaining(token.created, self.token_ttl),
+        )
+        self._mark_used(token, False)
+
+    def add_pin(self, session, pin):
+        if self.session_token(session.id):
+            raise TokenAlreadyExists()
+        self._kv.set(
+            self._key("pin", session.id),
+            pin,
+            ex=self._remaining(session.created, self.session_ttl),
+        )
+        return True
+
+    def redeem_pin(self, session_id, pin, token):
+        stored = self._kv.getdel(self._key("pin", session_id))
+        if stored is None or not _pin_matches(stored, pin):
+            return None
+        session = self.get_session(session_id)
+        if not session:
+            return None
+        try:
+            self.add_token(session, token)
+        except TokenAlreadyExists:
+            return self.session_token(session_id)
+        return token
+
+    def recent_sessions(self, limit=20):
+        sessions = []
+        for raw in self._kv.lrange(self._key("recent"), 0, limit - 1):
+            entry = json.loads(raw)
+            token = self._kv.get(self._key("session-token", entry["id"]))
+            token = json.loads(token) if token else {}
+            live = self._kv.get(self._key("session", entry["id"])) is not None
+            sessions.append(
+                {
+                    "username": entry["username"],
+                    "session_created": datetime.fromisoformat(entry["created"]),
+                    # Token records expire with the token, so a session with
+                    # neither left is over.
+                    "session_expired": not live and not token,
+                    "token_created": (
+                        datetime.fromisoformat(token["created"]) if token else None
+                    ),
+                    "used": token.get("used", False),
+                }
+            )
+        return sessions
+
+
+class MemoryKV:
+    """
+    In-process stand-in for the subset of the Redis API used by
+    KVStateStore. State is per process, so it is only suitable for tests and
+    single-worker development servers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def _live(self, name):
+        """
+        Return the (value, expires) entry for name, dropping it if expired.
+        """
+        entry = self._data.get(name)
+        if entry and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[name]
+            return None
+        return entry
+
+    def get(self, name):
+        """
+        Return the value of name, or None.
+        """
+        with self._lock:
+            entry = self._live(name)
+            return entry[0] if entry else None
+
+    def set(
+        self, name, value, ex=None, nx=False, xx=False, keepttl=False
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        """
+        Set name to value, expiring after ex seconds. Returns None if nx or
+        xx prevented the write, like Redis.
+        """
+        with self._lock:
+            entry = self._live(name)
+            if (nx and entry) or (xx and not entry):
+                return None
+            if keepttl and entry:
+                expires = entry[1]
+            else:
+                expires = time.monotonic() + ex if ex else None
+            self._data[name] = (value, expires)
+            return True
+
+    def getdel(self, name):
+        """
+        Atomically return and delete the value of name.
+        """
+        with self._lock:
+            entry = self._live(name)
+            if not entry:
+                return None
+            del self._data[name]
+            return entry[0]
+
+    def delete(self, *names):
+        """
+        Delete names and return how many existed.
+        """
+        with self._lock:
+            return sum(1 for name in names if self._data.pop(name, None))
+
+    def lpush(self, name, *values):
+        """
+        Prepend values to the list at name.
+        """
+        with self._lock:
+            entry = self._live(name)
+            items = list(reversed(values)) + (entry[0] if entry else [])
+            self._data[name] = (items, entry[1] if entry else None)
+            return len(items)
+
+    def ltrim(self, name, start, end):
+        """
+        Trim the list at name to the inclusive range start..end.
+        """
+        with self._lock:
+            entry = self._live(name)
+            if entry:
+                self._data[name] = (entry[0][start : end + 1], entry[1])
+            return True
+
+    def lrange(self, name, start, end):
+        """
+        Return the inclusive range start..end of the list at name.
+        """
+        with self._lock:
+            entry = self._live(name)
+            return entry[0][start : end + 1] if entry else []
+
+
+class TimedRedis:
+    """
+    Proxy for a Redis client that records the latency of every command.
+
+    Keyword arguments:
+    client -- Redis client to wrap
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        if not callable(command):
+            return command
+
+        def timed_command(*args, **kwargs):
+            with timed("redis", name):
+                return command(*args, **kwargs)
+
+        return timed_command
+
+
+def _build_store():
+    """
+    Create the store selected by RECOVERY_STATE_BACKEND.
+    """
+    ttls = {
+        "session_ttl": app.config["RECOVERY_SESSION_TTL"],
+        "token_ttl": app.config["RECOVERY_TOKEN_TTL"],
+    }
+    backend = app.config["RECOVERY_STATE_BACKEND"]
+    if backend == "redis":
+        client = redis.Redis.from_url(
+            app.config["RECOVERY_STATE_URL"], decode_responses=True
+        )
+        return KVStateStore(TimedRedis(client), **ttls)
+    if backend == "memory":
+        return KVStateStore(MemoryKV(), **ttls)
+    return SQLStateStore(**ttls)
+
+
+store = _build_store()
@@ -0,0 +1,143 @@
+"""
+Queued delivery of recovery messages, against a local SMTP sink and the
+logging SMS transport.
+"""
+
+import uuid
+from datetime import datetime
+
+import pytest
+
+from selfservice.models import OutboundMessage
+from selfservice.utilities import delivery
+from selfservice.utilities.smtp import SMTPPool
+from selfservice import db
+
+
+class FailingTransport:
+    """
+    Transport whose every send fails.
+    """
+
+    def send(self, message):
+        """
+        Refuse the message.
+        """
+        raise ConnectionError(f"cannot reach {message.recipient}")
+
+    def close(self):
+        """
+        Nothing to close.
+        """
+
+
+@pytest.fixture
+def session_id():
+    """
+    Session ID marking the messages of one test.
+    """
+    return f"test-{uuid.uuid4().hex}"[:36]
+
+
+@pytest.fixture
+def sink_pool(smtp_sink, monkeypatch):
+    """
+    Send email to the local sink.
+    """
+    pool = SMTPPool("127.0.0.1", smtp_sink.port, timeout=5)
+    monkeypatch.setattr(delivery, "smtp_pool", pool)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def transports(sink_pool):
+    """
+    Transports as a worker thread would build them, but with SMS logged.
+    """
+    return {"email": delivery.SMTPTransport(), "sms": delivery.LogTransport()}
+
+
+@pytest.fixture
+def no_wake(monkeypatch):
+    """
+    Keep the background workers out of tests that drain the queue by hand.
+    """
+    monkeypatch.setattr(delivery.workers, "wake", lambda: None)
+
+
+def _drain(transports):
+    """
+    Deliver every due message on this thread.
+    """
+    for message in delivery._claim(10):
+        delivery._deliver(message, transports)
+
+
+@pytest.mark.usefixtures("app_context", "no_wake")
+def test_email_is_sent_through_smtp(smtp_sink, transports, session_id):
+    message = delivery.enqueue(
+        "email", "member@example.com", "Reset link", "Hi", session=session_id
+    )
+    _drain(transports)
+
+    (recipients, body), *_ = smtp_sink.wait_for(1)
+    assert recipients == ["member@example.com"]
+    assert b"Subject: Hi" in body and b"Reset link" in body
+    assert db.session.get(OutboundMessage, message.id).status == "sent"
+
+
+@pytest.mark.usefixtures("app_context", "no_wake")
+def test_sms_goes_through_the_sms_transport(transports, session_id):
+    delivery.enqueue("sms", "5855550100", "Your PIN is 123456", session=session_id)
+    _drain(transports)
+
+    assert transports["sms"].sent == [("sms", "5855550100", "Your PIN is 123456")]
+    assert delivery.delivery_status(session_id)[0]["status"] == "sent"
+
+
+@pytest.mark.usefixtures("app_context", "no_wake")
+def test_failed_delivery_is_retried_later(session_id):
+    message = delivery.enqueue("sms", "5855550100", "PIN", session=session_id)
+    _drain({"sms": FailingTransport()})
+
+    message = db.session.get(OutboundMessage, message.id)
+    assert message.status == "queued"
+    assert message.attempts == 1
+    assert message.next_attempt > datetime.utcnow()
+    assert "cannot reach" in message.last_error
+    assert not delivery._claim(10)
+
+
+@pytest.mark.usefixtures("app_context", "no_wake")
+def test_delivery_gives_up_after_max_attempts(app, monkeypatch, session_id):
+    monkeypatch.setitem(app.config, "DELIVERY_MAX_ATTEMPTS", 1)
+    message = delivery.enqueue("sms", "5855550100", "PIN", session=session_id)
+    _drain({"sms": FailingTransport()})
+
+    assert db.session.get(OutboundMessage, message.id).status == "failed"
+
+
+# Leaves the worker threads running, so it comes after the tests that drain
+# the queue by hand.
+@pytest.mark.usefixtures("app_context", "sink_pool")
+def test_workers_send_messages_queued_before_they_started(smtp_sink, session_id):
+    db.session.add(
+        OutboundMessage(
+            channel="email",
+            recipient="member@example.com",
+            subject="Left over",
+            body="From before a restart",
+            session=session_id,
+            status="queued",
+            attempts=0,
+            next_attempt=datetime.utcnow(),
+        )
+    )
+    db.session.commit()
+
+    delivery.workers.wake()
+
+    (recipients, body), *_ = smtp_sink.wait_for(1)
+    assert recipients == ["member@example.com"]
+    assert b"From before a restart" in body
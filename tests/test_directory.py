@@ -0,0 +1,65 @@
+"""
+Loading behaviour of the in-memory member directory.
+"""
+
+import time
+
+import ldap
+import pytest
+
+from selfservice.utilities.directory import DirectoryUnavailable, MemberDirectory
+
+
+class FakeConnection:
+    """
+    Answers every paged search with one page of members.
+    """
+
+    def __init__(self, uids):
+        self.uids = uids
+
+    def search_ext(self, *_args, **_kwargs):
+        return 1
+
+    def result3(self, _msgid):
+        data = [
+            (f"uid={uid},cn=users", {"uid": [uid.encode()], "modifyTimestamp": [b"1"]})
+            for uid in self.uids
+        ]
+        return 101, data, 1, []
+
+
+class FakeLDAP:
+    """
+    Stands in for CSHLDAP. Without uids, every connection attempt fails.
+    """
+
+    def __init__(self, uids=None):
+        self.uids = uids
+
+    def get_con(self):
+        if self.uids is None:
+            raise ldap.SERVER_DOWN()
+        return FakeConnection(self.uids)
+
+
+def test_failed_load_does_not_block_callers():
+    directory = MemberDirectory(FakeLDAP(), interval=60)
+
+    with pytest.raises(DirectoryUnavailable):
+        directory.snapshot()
+
+    started = time.monotonic()
+    for _ in range(5):
+        with pytest.raises(DirectoryUnavailable):
+            directory.snapshot()
+    assert time.monotonic() - started < 0.5
+
+
+def test_loaded_directory_is_searchable():
+    directory = MemberDirectory(FakeLDAP(["alice", "bob"]), interval=60)
+
+    snapshot = directory.snapshot(timeout=5)
+
+    assert [member["value"] for member in snapshot.members] == ["alice", "bob"]
+    assert snapshot.index.search("bo") == [{"value": "bob", "display": "bob"}]
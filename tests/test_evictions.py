@@ -0,0 +1,67 @@
+"""
+Keycloak user ID evictions shared between workers through Postgres.
+"""
+
+import uuid
+
+import pytest
+from sqlalchemy import delete, select
+
+from selfservice.models import KeycloakUserEviction
+from selfservice.utilities.cache import TTLCache
+from selfservice.utilities.keycloak import SharedEvictions
+from selfservice import db
+
+
+@pytest.fixture
+def username(app_context):
+    """
+    A username whose eviction rows are removed afterwards.
+    """
+    name = f"test-{uuid.uuid4().hex}"
+    yield name
+    with db.engine.begin() as conn:
+        conn.execute(
+            delete(KeycloakUserEviction).where(KeycloakUserEviction.username == name)
+        )
+
+
+def worker():
+    """
+    The eviction state of one worker, checking the table on every lookup.
+    """
+    return SharedEvictions(TTLCache(), interval=0)
+
+
+def test_eviction_reaches_other_workers(username):
+    first, second = worker(), worker()
+    second.apply()
+    second.cache.set(username, "id")
+
+    first.publish(username)
+    second.apply()
+
+    assert second.cache.get(username) is None
+
+
+def test_eviction_during_outage_is_applied(username):
+    # The first check failed, so this worker cached the ID without a
+    # starting point in the table.
+    late = worker()
+    late.cache.set(username, "id")
+
+    worker().publish(username)
+    late.apply()
+
+    assert late.cache.get(username) is None
+
+
+def test_checks_leave_the_session_alone(username):
+    evictions = worker()
+    db.session.execute(select(1))
+
+    evictions.apply()
+    evictions.publish(username)
+    evictions.apply()
+
+    assert db.session().in_transaction()
@@ -0,0 +1,63 @@
+"""
+Input handling of the internal app password verification API.
+"""
+
+import json
+
+import pytest
+
+TOKEN = "test-internal-token"
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    """
+    A test client with the internal API enabled.
+    """
+    monkeypatch.setitem(app.config, "INTERNAL_API_TOKEN", TOKEN)
+    return app.test_client()
+
+
+def verify(client, body):
+    """
+    POST a raw JSON body to the verify endpoint.
+    """
+    return client.post(
+        "/internal/app-passwd/verify",
+        data=body,
+        content_type="application/json",
+        headers={"Authorization": f"Bearer {TOKEN}"},
+    )
+
+
+def test_rejects_missing_token(client):
+    response = client.post("/internal/app-passwd/verify", json={})
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize(
+    "credentials",
+    [
+        {"user": "alice"},
+        {"user": 1, "password": "secret"},
+        {"user": "alice", "password": ["secret"]},
+        {"user": "alice", "password": {"p": "secret"}},
+        {"user": None, "password": None},
+        ["alice", "secret"],
+        "alice",
+    ],
+)
+def test_rejects_non_string_fields(client, credentials):
+    response = verify(client, json.dumps(credentials))
+    assert response.status_code == 400
+
+
+def test_rejects_lone_surrogate(client):
+    response = verify(client, '{"user": "alice", "password": "\\ud800"}')
+    assert response.status_code == 400
+
+
+def test_unavailable_without_lookup_key(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, "APP_PASSWD_LOOKUP_KEY", "")
+    response = verify(client, json.dumps({"user": "alice", "password": "secret"}))
+    assert response.status_code == 503
@@ -0,0 +1,81 @@
+"""
+Failover of the pooled FreeIPA LDAP connections.
+"""
+
+import pytest
+import requests
+
+from selfservice.utilities.ldap_pool import LDAPConnectionPool, _PooledConnection
+from selfservice.utilities.srv import SRVResolver
+
+ERRORS = (requests.ConnectionError,)
+
+
+class FakeConnection:
+    """
+    Stands in for an LDAPObject bound to host.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.unbound = False
+
+    def whoami_s(self):
+        return "dn:uid=selfservice"
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+@pytest.fixture
+def servers():
+    """
+    A resolver with a cached answer preferring host a over host b.
+    """
+    resolver = SRVResolver("ldap", "tcp", "example.com")
+    resolver._records = [(0, 0, "a", 636), (10, 0, "b", 636)]
+    resolver._expires = float("inf")
+    return resolver
+
+
+@pytest.fixture
+def pool(servers, monkeypatch):
+    """
+    A pool opening fake connections, holding two idle connections to a.
+    """
+    ldap_pool = LDAPConnectionPool(servers, "uid=selfservice", "secret")
+    monkeypatch.setattr(
+        ldap_pool, "_open", lambda host: _PooledConnection(FakeConnection(host), host)
+    )
+    for _ in range(2):
+        ldap_pool._idle.put(_PooledConnection(FakeConnection("a"), "a"))
+    return ldap_pool
+
+
+def test_retry_fails_over_to_a_healthy_host(pool, servers):
+    calls = []
+
+    def reset(conn, host):
+        calls.append(host)
+        if host == "a":
+            raise requests.ConnectionError()
+        return conn
+
+    conn = pool.run(reset, ERRORS)
+
+    assert calls == ["a", "b"]
+    assert conn.host == "b"
+    assert servers.is_unhealthy("a")
+
+
+def test_idle_connections_to_unhealthy_hosts_are_dropped(pool, servers):
+    servers.mark_unhealthy("a")
+    idle = [pool._idle.get_nowait() for _ in range(2)]
+    for entry in idle:
+        pool._idle.put(entry)
+
+    with pool.connection() as (conn, host):
+        assert host == "b"
+
+    assert all(entry.conn.unbound for entry in idle)
+    assert pool._idle.qsize() == 1
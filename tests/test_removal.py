@@ -0,0 +1,92 @@
+"""
+Deadlines and pool isolation of the concurrent two-factor removal.
+"""
+
+import threading
+
+import pytest
+
+from selfservice.utilities.keycloak import OTPNotConfigured
+from selfservice.utilities.removal import incomplete, remove_two_factor
+
+
+@pytest.fixture
+def hang():
+    """
+    A removal step that blocks until the test ends.
+    """
+    release = threading.Event()
+
+    def step(_username):
+        release.wait(30)
+
+    yield step
+    release.set()
+
+
+def removed(_username):
+    pass
+
+
+def not_configured(_username):
+    raise OTPNotConfigured()
+
+
+def broken(_username):
+    raise ValueError()
+
+
+def test_reports_each_step():
+    results = remove_two_factor(
+        "alice",
+        steps={"a": removed, "b": not_configured, "c": broken},
+        timeout=5,
+    )
+    assert [result["status"] for result in results.values()] == [
+        "removed",
+        "not_configured",
+        "failed",
+    ]
+    assert results["c"]["error"] == "ValueError"
+    assert incomplete(results) == ["c"]
+
+
+def test_hung_backend_does_not_skip_others(app, hang):
+    workers = app.config["OTP_REMOVE_WORKERS"]
+    # Fill the hung backend's pool, as earlier stuck removals would
+    for _ in range(workers):
+        results = remove_two_factor(
+            "alice", steps={"test-hung": hang, "test-ok": removed}, timeout=0.2
+        )
+        assert results["test-hung"]["status"] == "timeout"
+        assert results["test-ok"]["status"] == "removed"
+
+    results = remove_two_factor(
+        "alice", steps={"test-hung": hang, "test-ok": removed}, timeout=0.2
+    )
+    assert results["test-hung"] == {"status": "skipped"}
+    assert results["test-ok"]["status"] == "removed"
+
+
+def test_queued_step_gets_its_own_timeout(app):
+    release = threading.Event()
+
+    def blocker(_username):
+        release.wait(30)
+
+    def slow(_username):
+        threading.Event().wait(0.3)
+
+    workers = app.config["OTP_REMOVE_WORKERS"]
+    try:
+        for _ in range(workers):
+            remove_two_factor("alice", steps={"test-queued": blocker}, timeout=0.05)
+        # Free the pool shortly after the next step is queued, so it starts
+        # late and would time out against a deadline shared with the others
+        threading.Timer(0.3, release.set).start()
+        results = remove_two_factor(
+            "alice", steps={"test-queued": slow, "test-ok": removed}, timeout=0.5
+        )
+    finally:
+        release.set()
+    assert results["test-queued"]["status"] == "removed"
@@ -0,0 +1,47 @@
+"""
+Sending through the SMTP connection pool, against a local SMTP sink.
+"""
+
+import smtplib
+
+import pytest
+
+from selfservice.utilities.smtp import SMTPPool, make_message
+
+
+@pytest.fixture
+def pool(smtp_sink):
+    """
+    A pool relaying through the sink, retiring sessions after two messages.
+    """
+    smtp_pool = SMTPPool("127.0.0.1", smtp_sink.port, timeout=5, max_messages=2)
+    yield smtp_pool
+    smtp_pool.close()
+
+
+def notification(recipient):
+    return make_message("selfservice@csh.rit.edu", recipient, "Notice", "Hello")
+
+
+def test_send_reuses_the_session(pool, smtp_sink):
+    for _ in range(2):
+        pool.send(notification("alice@csh.rit.edu"))
+
+    assert len(smtp_sink.wait_for(2)) == 2
+    assert smtp_sink.connections == 1
+
+
+def test_send_many_reports_refused_messages(pool, smtp_sink):
+    recipients = [f"rtp{number}@csh.rit.edu" for number in range(4)]
+    messages = [notification(recipient) for recipient in recipients]
+    messages.insert(2, notification("refused@csh.rit.edu"))
+
+    failed = pool.send_many(messages)
+
+    assert [(message, type(error)) for message, error in failed] == [
+        (messages[2], smtplib.SMTPRecipientsRefused)
+    ]
+    delivered = smtp_sink.wait_for(4)
+    assert [recipient for recipient, _ in delivered] == [[r] for r in recipients]
+    # Four messages on sessions retired after two each
+    assert smtp_sink.connections == 2
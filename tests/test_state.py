@@ -0,0 +1,194 @@
+"""
+Recovery state stores: issuing, claiming and redeeming tokens and PINs, and
+expiry. Every behaviour is checked against the in-memory key-value backend,
+and against Postgres when it is reachable.
+"""
+
+import random
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from selfservice.utilities import state
+from selfservice.utilities.state import (
+    KVStateStore,
+    MemoryKV,
+    RecoveryStateStore,
+    SQLStateStore,
+    TokenAlreadyExists,
+)
+
+
+class Clock:
+    """
+    Monotonic clock that only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        """
+        Current time.
+        """
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Freeze time for MemoryKV.
+    """
+    fake = Clock()
+    monkeypatch.setattr(state, "time", SimpleNamespace(monotonic=fake.monotonic))
+    return fake
+
+
+@pytest.fixture(params=["memory", "sql"])
+def store(request):
+    """
+    A store of each backend, with short TTLs.
+    """
+    if request.param == "memory":
+        yield KVStateStore(MemoryKV(), session_ttl=60, token_ttl=120)
+        return
+
+    app = request.getfixturevalue("app")
+    database = request.getfixturevalue("database")
+    # pylint: disable-next=import-outside-toplevel
+    from selfservice.models import PhoneVerification, RecoverySession, ResetToken
+
+    with app.app_context():
+        yield SQLStateStore(session_ttl=60, token_ttl=120)
+        database.session.rollback()
+        ids = RecoverySession.query.with_entities(RecoverySession.id).filter(
+            RecoverySession.username.like("pytest-%")
+        )
+        for model in (PhoneVerification, ResetToken):
+            model.query.filter(model.session.in_(ids.scalar_subquery())).delete(
+                synchronize_session=False
+            )
+        RecoverySession.query.filter(RecoverySession.username.like("pytest-%")).delete(
+            synchronize_session=False
+        )
+        database.session.commit()
+
+
+def _new_session(store):
+    """
+    Create a session for a throwaway user.
+    """
+    return store.create_session(f"pytest-{uuid.uuid4().hex[:8]}", {"email": []})
+
+
+def _pin():
+    """
+    A random PIN, so runs against a shared database do not collide.
+    """
+    return f"{random.randrange(1, 10**6):06}"
+
+
+def test_incomplete_backend_cannot_be_created():
+    class Partial(RecoveryStateStore):  # pylint: disable=abstract-method
+        def create_session(self, username, methods=None):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()  # pylint: disable=abstract-class-instantiated
+
+
+def test_session_round_trip(store):
+    session = _new_session(store)
+
+    found = store.get_session(session.id)
+    assert found.username == session.username
+    assert found.methods == {"email": []}
+
+    store.save_methods(session.id, {"email": [], "phone": ["5855550100"]})
+    assert store.get_session(session.id).methods["phone"] == ["5855550100"]
+    assert store.get_session(str(uuid.uuid4())) is None
+
+
+def test_session_gets_one_token(store):
+    session = _new_session(store)
+    token = str(uuid.uuid4())
+    store.add_token(session, token)
+
+    with pytest.raises(TokenAlreadyExists):
+        store.add_token(session, str(uuid.uuid4()))
+    assert store.session_token(session.id) == token
+    assert store.get_token(token).username == session.username
+
+
+def test_token_is_claimed_once(store):
+    session = _new_session(store)
+    token = str(uuid.uuid4())
+    store.add_token(session, token)
+
+    claimed = store.claim_token(token)
+    assert claimed.username == session.username
+    assert store.claim_token(token) is None
+    assert store.get_token(token) is None
+
+    store.release_token(claimed)
+    assert store.claim_token(token).session == session.id
+
+
+def test_right_pin_issues_the_token(store):
+    session = _new_session(store)
+    pin = _pin()
+    assert store.add_pin(session, pin)
+
+    token = str(uuid.uuid4())
+    assert store.redeem_pin(session.id, pin, token) == token
+    assert store.session_token(session.id) == token
+    with pytest.raises(TokenAlreadyExists):
+        store.add_pin(session, _pin())
+
+
+@pytest.mark.parametrize("attempt", ["000000", "12345é", "１２３４５６", "12345", ""])
+def test_wrong_pin_uses_it_up(store, attempt):
+    session = _new_session(store)
+    pin = _pin()
+    if pin == attempt:
+        pin = "999999"
+    store.add_pin(session, pin)
+
+    assert store.redeem_pin(session.id, attempt, str(uuid.uuid4())) is None
+    assert store.redeem_pin(session.id, pin, str(uuid.uuid4())) is None
+    assert store.session_token(session.id) is None
+
+
+def test_session_and_pin_expire(clock):
+    store = KVStateStore(MemoryKV(), session_ttl=60, token_ttl=120)
+    session = _new_session(store)
+    store.add_pin(session, "123456")
+
+    clock.now += 61
+    assert store.get_session(session.id) is None
+    assert store.redeem_pin(session.id, "123456", str(uuid.uuid4())) is None
+
+
+def test_token_expires(clock):
+    store = KVStateStore(MemoryKV(), session_ttl=60, token_ttl=120)
+    session = _new_session(store)
+    token = str(uuid.uuid4())
+    store.add_token(session, token)
+
+    clock.now += 119
+    assert store.get_token(token) is not None
+    clock.now += 2
+    assert store.get_token(token) is None
+    assert store.claim_token(token) is None
+
+
+def test_recent_sessions_reports_token_use(store):
+    session = _new_session(store)
+    token = str(uuid.uuid4())
+    store.add_token(session, token)
+    store.claim_token(token)
+
+    recent = {s["username"]: s for s in store.recent_sessions(100)}
+    assert recent[session.username]["used"]
+    assert recent[session.username]["token_created"] is not None